@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# Memory held per block once a chain is loaded.
+#
+#   python3 bench/bench_block_memory.py [--blocks 100000]
+
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from decimal import Decimal
+from uuid import uuid4
+
+
+def build_chain(chain_path, num_blocks):
+    os.environ['DUO_CHAIN_PATH'] = chain_path
+
+    from config import config
+    config['DUO_CHAIN_PATH'] = chain_path
+
+    from chain import init_chain
+
+    chain = init_chain()
+    peers = [str(uuid4()) for _ in range(20)]
+
+    # A mix of the common block types, with a handful of counterparties
+    with chain.batch():
+        i = 0
+        while len(chain.blocks) < num_blocks:
+            peer = peers[i % len(peers)]
+            signal_block = chain.send_signal(peer, {'signal': f'signal-{i % 100}'})
+            chain.debit(Decimal('1'), ref_block_hash=signal_block.block_hash)
+            received_block = chain.receive_signal(peer, signal_block.block_hash, {'signal': f'signal-{i % 100}'})
+            chain.add_action(str(uuid4()), str(uuid4()), {'signal': [received_block.block_hash]})
+            chain.accept_credit(Decimal('2'), ref_block_hash=received_block.block_hash)
+            i += 1
+
+    return chain
+
+
+def measure_load(chain_file):
+    from chain import get_loader
+
+    loader = get_loader(chain_file)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    t = time.time()
+    _, _, blocks, _ = loader.load()
+    load_secs = time.time() - t
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return blocks, after - before, load_secs
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure memory per loaded block')
+    parser.add_argument('--blocks', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as chain_path:
+        chain = build_chain(chain_path, args.blocks)
+        chain_file = chain.loader.json_path
+        del chain
+
+        blocks, num_bytes, load_secs = measure_load(chain_file)
+
+        print(json.dumps({
+            'blocks': len(blocks),
+            'file_bytes': os.path.getsize(chain_file),
+            'retained_bytes': num_bytes,
+            'bytes_per_block': round(num_bytes / len(blocks), 1),
+            'load_secs': round(load_secs, 3),
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+# Time to load a large chain, and to deserialize its blocks through the
+# loader (BLOCK_CLASSES + Block.hydrate) vs. through the block constructors.
+#
+#   python3 bench/bench_load.py [--blocks 1000000] [--template 10000]
+#
+# The blocks are a --template chain built through the Chain API, repeated
+# with renumbered heights until there are --blocks of them. Loading doesn't
+# check hashes, so the repeats load the same as real blocks would.
+
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_block_memory import build_chain
+
+
+def write_chain(chain_file, template_file, num_blocks):
+    with open(template_file, 'r') as f:
+        template = json.loads(f.read())
+
+    blocks = []
+    while len(blocks) < num_blocks:
+        for serialized_block in template['blocks'][:num_blocks - len(blocks)]:
+            blocks.append({**serialized_block, 'height': len(blocks) + 1})
+
+    with open(chain_file, 'w') as f:
+        f.write(json.dumps({**template, 'blocks': blocks}))
+
+
+def time_call(fn, *args):
+    t = time.time()
+    result = fn(*args)
+    return result, time.time() - t
+
+
+def construct_blocks(serialized_blocks):
+    # Every block through its class' __init__, as loading used to
+    from blocks import BLOCK_CLASSES
+    return [BLOCK_CLASSES[serialized_block['block_type']](serialized_block) for serialized_block in serialized_blocks]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure chain load time')
+    parser.add_argument('--blocks', type=int, default=1000000)
+    parser.add_argument('--template', type=int, default=10000, help='blocks built through the Chain API')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as chain_path:
+        template_chain = build_chain(chain_path, min(args.template, args.blocks))
+        template_file = template_chain.loader.json_path
+        del template_chain
+
+        chain_file = os.path.join(chain_path, 'bench_load.json')
+        write_chain(chain_file, template_file, args.blocks)
+
+        from chain import JSONLoader
+
+        loader = JSONLoader(chain_file)
+
+        with open(chain_file, 'r') as f:
+            serialized_blocks, parse_secs = time_call(lambda: json.loads(f.read())['blocks'])
+
+        blocks, hydrate_secs = time_call(loader.init_blocks, serialized_blocks)
+        del blocks
+
+        blocks, construct_secs = time_call(construct_blocks, serialized_blocks)
+        del blocks, serialized_blocks
+
+        (_, _, blocks, _), load_secs = time_call(loader.load)
+
+        print(json.dumps({
+            'blocks': len(blocks),
+            'file_bytes': os.path.getsize(chain_file),
+            'json_parse_secs': round(parse_secs, 3),
+            'init_blocks_secs': round(hydrate_secs, 3),
+            'constructor_secs': round(construct_secs, 3),
+            'speedup': round(construct_secs / hydrate_secs, 2),
+            'load_secs': round(load_secs, 3),
+            'blocks_per_sec': round(len(blocks) / load_secs),
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+# Timings of the chain hot paths over a synthetic population, as JSON, so
+# runs on different commits can be diffed.
+#
+#   python3 bench/bench_suite.py --size small
+#   python3 bench/bench_suite.py --chains 20 --blocks 100000 --repeat 3 --out before.json
+#   python3 bench/bench_suite.py --path /tmp/chains   # an existing population, see generate.py
+#
+# An existing population is copied first, the suite adds blocks to its chains.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from decimal import Decimal
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import SIZES, generate
+
+
+class Suite():
+
+    def __init__(self, chain_path, repeat=5):
+        self.chain_path = chain_path
+        self.repeat = repeat
+        self.results = {}
+
+    def time(self, name, fn, setup=None, repeat=None):
+        # fn(setup()) timed `repeat` times; setup isn't timed. Output from
+        # the chain code (hard_verify is chatty) is dropped.
+        secs = []
+        for _ in range(repeat or self.repeat):
+            with redirect_stdout(None):
+                arg = setup() if setup else None
+
+                t = time.perf_counter()
+                fn(arg)
+                secs.append(time.perf_counter() - t)
+
+        self.results[name] = {
+            'min_secs': round(min(secs), 6),
+            'median_secs': round(median(secs), 6),
+            'max_secs': round(max(secs), 6),
+            'repeat': len(secs),
+        }
+
+    def run(self):
+        from chain import Chain, get_loader, get_chain_files
+
+        chain_files = sorted(get_chain_files(self.chain_path), key=os.path.getsize)
+        chain_file = chain_files[-1]
+
+        def fresh_chain(chain_file=chain_file):
+            return Chain(None, get_loader(chain_file))
+
+        chain = fresh_chain()
+
+        # The counterparty with the most blocks in the chain
+        chain.ensure_index()
+        peer_counts = {peer: len(positions) for peer, positions in chain.peer_index.items()}
+        peer_id = max(peer_counts, key=peer_counts.get)
+        peer_file = [f for f in chain_files if peer_id in os.path.basename(f)][0]
+
+        self.population = {
+            'chains': len(chain_files),
+            'blocks': sum(len(get_loader(f).load()[2]) for f in chain_files),
+            'bytes': sum(os.path.getsize(f) for f in chain_files),
+            'largest_chain_blocks': len(chain.blocks),
+        }
+
+        # Storage
+        loader = get_loader(chain_file)
+        self.time('load', lambda _: loader.load())
+        self.time('load_all', lambda _: [Chain(None, get_loader(f)) for f in chain_files], repeat=1)
+        self.time('save_full', lambda chain: chain.save(full=True), setup=fresh_chain)
+        self.time('append_save', lambda chain: chain.debit(Decimal('1')), setup=lambda: chain, repeat=self.repeat * 10)
+
+        # Validation
+        self.time('verify_cold', lambda chain: chain.verify(quiet=True), setup=fresh_chain)
+        self.time('verify_warm', lambda chain: chain.verify(quiet=True), setup=lambda: chain)
+        self.time('verify_incremental', lambda chain: chain.verify(quiet=True, incremental=True), setup=lambda: chain)
+        self.time('find_invalid', lambda chain: chain.find_invalid(), setup=fresh_chain)
+        self.time('make_valid_dry_run', lambda chain: chain.make_valid(dry_run=True), setup=fresh_chain)
+
+        # Credibility
+        self.time('get_credibility', lambda chain: chain.get_credibility(), setup=lambda: chain)
+        self.time('get_credibility_minimal_cold', lambda chain: chain.get_credibility(minimal=True), setup=fresh_chain)
+        self.time('get_credibility_minimal_warm', lambda chain: chain.get_credibility(minimal=True), setup=lambda: chain)
+
+        # Queries
+        from blocks import BlockType
+        self.time('block_query_type', lambda chain: chain.block_query(BlockType.SignalSent, multiple=True), setup=lambda: chain)
+        self.time('block_query_predicate', lambda chain: chain.block_query(
+            predicates=[{'key': 'signal_data.kind', 'value': 'ask'}], multiple=True), setup=lambda: chain)
+        self.time('block_query_peer', lambda chain: chain.block_query(
+            predicates=[{'key': 'dest_chain_id', 'value': peer_id}], multiple=True), setup=lambda: chain)
+        window_near = chain.blocks[-1].ts
+        window_far = chain.blocks[len(chain.blocks) // 2].ts
+        self.time('block_query_window', lambda chain: chain.block_query(
+            [BlockType.SignalSent, BlockType.SignalReceived], window_far=window_far, window_near=window_near, multiple=True), setup=lambda: chain)
+        self.time('query_blocks_page', lambda chain: chain.query_blocks(BlockType.Action, limit=50, newest_first=True), setup=lambda: chain)
+
+        # Verification between chains, each run adds blocks to both
+        self.time('hard_verify', lambda chains: chains[0].hard_verify(chains[1]),
+                  setup=lambda: (fresh_chain(), fresh_chain(peer_file)))
+        self.time('cross_verify', lambda chains: chains[0].cross_verify(chains[1]),
+                  setup=lambda: (fresh_chain(), fresh_chain(peer_file)))
+
+        self.run_http(chain.uuid, peer_id)
+
+        return {
+            'population': self.population,
+            'results': self.results,
+        }
+
+    def run_http(self, chain_id, peer_id):
+        # The main endpoints, in process through the ASGI app
+        import warnings
+        warnings.filterwarnings('ignore')
+
+        from config import config
+        config['DUO_CHAIN_PATH'] = self.chain_path
+
+        from fastapi.testclient import TestClient
+        import server
+
+        client = TestClient(server.app)
+
+        def get(url):
+            return lambda _: client.get(url).raise_for_status()
+
+        def post(url, body):
+            return lambda _: client.post(url, json=body).raise_for_status()
+
+        self.time('http_state', get('/state'))
+        self.time('http_chain', get(f'/chain/{chain_id}'))
+        self.time('http_chain_stream', get(f'/chain/{chain_id}/stream'))
+        self.time('http_verify', get(f'/chain/{chain_id}/verify'))
+        self.time('http_credibility', get(f'/chain/{chain_id}/credibility/{peer_id}'))
+        self.time('http_block_query', post(f'/chain/{chain_id}/block/query', {
+            'predicates': [{'key': 'dest_chain_id', 'value': peer_id}], 'limit': 50, 'newest_first': True}))
+        self.time('http_send_signal', post(f'/chain/{chain_id}/block/send_signal', {
+            'other_chain_uuid': peer_id, 'signal_data': {'signal': 'bench'}, 'reward_amount': '1', 'debit': True}))
+        self.time('http_hard_verify', get(f'/chain/{chain_id}/hard_verify/{peer_id}'))
+
+
+def get_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    import argparse
+    import platform
+
+    parser = argparse.ArgumentParser(description='Time the chain hot paths over a synthetic population')
+    parser.add_argument('--path', help='existing population to copy (default: generate one)')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--chains', type=int, help='number of chains (default: from --size)')
+    parser.add_argument('--blocks', type=int, help='total number of blocks (default: from --size)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', choices=['json', 'log'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        chain_path = os.path.join(tmp_path, 'chains')
+
+        generate_secs = None
+        if args.path:
+            shutil.copytree(args.path, chain_path)
+        else:
+            num_chains, num_blocks = SIZES[args.size]
+            os.makedirs(chain_path)
+
+            t = time.time()
+            generate(chain_path, args.chains or num_chains, args.blocks or num_blocks, seed=args.seed, storage=args.storage)
+            generate_secs = round(time.time() - t, 3)
+
+        report = Suite(chain_path, repeat=args.repeat).run()
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'generate_secs': generate_secs,
+        **report,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+# Synthetic chain populations, built through the Chain API so the blocks,
+# hashes and cross-chain references are the same as the server would make.
+#
+#   python3 bench/generate.py --path /tmp/chains --size medium
+#   python3 bench/generate.py --path /tmp/chains --chains 50 --blocks 20000
+
+import os
+import sys
+import random
+from contextlib import redirect_stdout
+from decimal import Decimal
+from uuid import UUID
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# name -> (chains, total blocks)
+SIZES = {
+    'small': (10, 1000),
+    'medium': (100, 100000),
+    'large': (10000, 1000000),
+}
+
+
+class Population():
+    # Chains exchanging the flows the server's endpoints produce. Random
+    # choices come from one seeded Random, so the same arguments give the
+    # same population shape (uuids and timestamps aside).
+
+    def __init__(self, chains, seed=0, verify_every=50):
+        self.chains = chains
+        self.rng = random.Random(seed)
+        self.verify_every = verify_every
+        self.num_flows = 0
+
+        self.flows = [
+            (self.signal_flow, 6),
+            (self.action_flow, 3),
+            (self.target_flow, 1),
+            (self.access_contract_flow, 1),
+        ]
+
+    def num_blocks(self):
+        return sum(len(chain.blocks) for chain in self.chains)
+
+    def uuid(self):
+        return str(UUID(int=self.rng.getrandbits(128), version=4))
+
+    def pair(self):
+        if len(self.chains) < 2:
+            raise Exception('A population needs at least 2 chains')
+
+        return self.rng.sample(self.chains, 2)
+
+    def grow(self, num_blocks):
+        flows, weights = zip(*self.flows)
+
+        while self.num_blocks() < num_blocks:
+            flow = self.rng.choices(flows, weights)[0]
+            flow(*self.pair())
+            self.num_flows += 1
+
+            if self.verify_every and self.num_flows % self.verify_every == 0:
+                chain, other_chain = self.pair()
+                if chain.get_peer_positions(other_chain.uuid):
+                    with redirect_stdout(None):
+                        chain.hard_verify(other_chain)
+
+    def signal_flow(self, chain, other_chain):
+        # send_signal (+debit) -> receive_signal -> deliver_signal -> rewards -> credit
+        amount = Decimal(self.rng.randint(1, 5))
+        signal_data = {'signal': f'signal-{self.rng.randint(0, 99)}', 'kind': self.rng.choice(('ask', 'offer', 'note'))}
+        activity_id = self.uuid()
+
+        send_block = chain.send_signal(other_chain.uuid, signal_data, amount=amount)
+        chain.debit(amount, ref_block_hash=send_block.block_hash)
+
+        receive_block = other_chain.receive_signal(chain.uuid, send_block.block_hash, signal_data, amount=amount)
+        deliver_block = other_chain.deliver_signal(chain.uuid, receive_block.block_hash, activity_id, cost=1, amount=amount)
+        other_chain.add_action(self.uuid(), activity_id, {'signal': [deliver_block.block_hash]},
+                               deliver_signal_block_hash=deliver_block.block_hash)
+
+        reward_block = other_chain.send_signal_reward(chain.uuid, '', deliver_block.block_hash, amount, accepted_amount=amount)
+        reward_received_block = chain.receive_signal_reward(other_chain.uuid, reward_block.block_hash, amount)
+        chain.accept_credit(amount, ref_block_hash=reward_received_block.block_hash)
+
+    def action_flow(self, chain, other_chain):
+        # Actions and a work output within one activity, rewarded by the other chain
+        activity_id = self.uuid()
+        action_id = self.uuid()
+
+        action_block = chain.add_action(action_id, activity_id, {'prior': [self.uuid()]})
+        work_output_block = chain.add_work_output(action_id, activity_id, {'action': [action_block.block_hash]},
+                                                  {'summary': f'output-{self.rng.randint(0, 999)}'})
+
+        amount = Decimal(self.rng.randint(1, 3))
+        reward_block = other_chain.send_work_output_reward(chain.uuid, amount, work_output_block.block_hash)
+        chain.receive_work_output_reward(other_chain.uuid, amount, work_output_block.block_hash, reward_block.block_hash)
+
+    def target_flow(self, chain, other_chain):
+        # chain posts a target, other_chain accepts it, claims it and is rewarded
+        target_id = self.uuid()
+        reward = Decimal(self.rng.randint(1, 10))
+
+        target_block = chain.add_target(f'target-{target_id[:8]}', target_id, reward, reward * 4)
+        other_chain.accept_target(chain.uuid, target_id, target_block.block_hash, {'name': target_block.name})
+
+        activity_id = self.uuid()
+        action_id = self.uuid()
+        work_output_block = other_chain.add_work_output(action_id, activity_id, {'target': [target_block.block_hash]},
+                                                        {'target_id': target_id})
+
+        details = {'work_output_block_hash': work_output_block.block_hash}
+        claim_block = other_chain.send_target_reward_claim(chain.uuid, target_block.block_hash, work_output_block.block_hash, details)
+        claim_received_block = chain.receive_target_reward_claim(other_chain.uuid, target_block.block_hash, claim_block.block_hash,
+                                                                 work_output_block.block_hash, details)
+
+        reward_block = chain.send_target_reward(other_chain.uuid, target_block.block_hash, claim_received_block.block_hash, reward)
+        other_chain.receive_target_reward(chain.uuid, target_block.block_hash, reward_block.block_hash, reward)
+
+    def access_contract_flow(self, chain, other_chain):
+        # chain sells other_chain access, other_chain opens an event on it
+        import time
+
+        amount = Decimal(self.rng.randint(1, 5))
+        own_block = chain.add_access_contract_own(other_chain.uuid, amount, self.uuid(), self.uuid(), self.uuid(), 3600, Decimal('1'))
+        other_block = other_chain.add_access_contract_other(chain.uuid, own_block.block_hash, amount, own_block.token,
+                                                            int(time.time()), 3600, Decimal('1'))
+
+        event_open_block = other_chain.add_access_contract_other_event_open(other_block.block_hash, own_block.block_hash, amount)
+
+        send_block = other_chain.send_signal(chain.uuid, {'signal': 'access'})
+        receive_block = chain.receive_signal(other_chain.uuid, send_block.block_hash, {'signal': 'access'})
+        ask_block = chain.add_access_contract_own_event_ask(own_block.block_hash, event_open_block.block_hash,
+                                                            receive_block.block_hash, amount)
+
+        other_chain.add_access_contract_other_event_close(other_block.block_hash, own_block.block_hash,
+                                                          event_open_block.block_hash, ask_block.block_hash, '')
+
+
+def generate(chain_path, num_chains, num_blocks, seed=0, storage=None, verify_every=50):
+    # Creates num_chains chains in chain_path holding about num_blocks blocks
+    # between them, and returns them. Each chain is saved once at the end.
+    from config import config
+    config['DUO_CHAIN_PATH'] = chain_path
+    if storage:
+        config['DUO_CHAIN_STORAGE'] = storage
+
+    from chain import init_chain, batch
+
+    chains = [init_chain() for _ in range(num_chains)]
+
+    with batch(*chains):
+        Population(chains, seed=seed, verify_every=verify_every).grow(num_blocks)
+
+    return chains
+
+
+def main():
+    import json
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic chain population')
+    parser.add_argument('--path', required=True, help='chain directory to create the chains in')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--chains', type=int, help='number of chains (default: from --size)')
+    parser.add_argument('--blocks', type=int, help='total number of blocks (default: from --size)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', choices=['json', 'log'])
+    args = parser.parse_args()
+
+    num_chains, num_blocks = SIZES[args.size]
+    num_chains = args.chains or num_chains
+    num_blocks = args.blocks or num_blocks
+
+    os.makedirs(args.path, exist_ok=True)
+
+    t = time.time()
+    chains = generate(args.path, num_chains, num_blocks, seed=args.seed, storage=args.storage)
+
+    print(json.dumps({
+        'path': args.path,
+        'chains': len(chains),
+        'blocks': sum(len(chain.blocks) for chain in chains),
+        'generate_secs': round(time.time() - t, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from decimal import Decimal
+from functools import lru_cache
 import json
 
 
@@ -90,8 +91,63 @@ class BlockHash():
         pass
 
 
+# block_type -> class, filled in by BlockMeta for every concrete block class
+BLOCK_CLASSES = {}
+
+# Set on the class, shared by every block of that class
+CLASS_ATTRS = ('block_type', 'dict_props', 'immutable_balance', 'slot_defaults', 'ref_fields')
+
+# Fields that aren't part of get_hashable(), assigning them keeps Block.computed_hash
+UNHASHED_FIELDS = frozenset(('block_hash', 'computed_hash'))
+
+
+class BlockMeta(type):
+    # The per-block fields declared with their defaults in a Block class body
+    # become __slots__, so blocks carry no per-instance __dict__. The
+    # defaults, including those inherited, end up in slot_defaults and are
+    # set on each new block by Block.__new__().
+
+    def __new__(mcs, name, bases, namespace):
+        slot_defaults = {}
+        for base in bases:
+            slot_defaults.update(getattr(base, 'slot_defaults', {}))
+
+        slots = []
+        for key, val in list(namespace.items()):
+            if key.startswith('__') or key in CLASS_ATTRS or callable(val) or isinstance(val, (staticmethod, classmethod, property)):
+                continue
+
+            if key not in slot_defaults:
+                slots.append(key)
+
+            slot_defaults[key] = namespace.pop(key)
+
+        namespace['__slots__'] = tuple(slots)
+        namespace['slot_defaults'] = slot_defaults
+
+        # Fields holding the hash of another block (this chain's or the other chain's)
+        namespace['ref_fields'] = tuple(key for key in slot_defaults if key.endswith('_block_hash') and key != 'prev_block_hash')
+
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        # The same class without Block.__setattr__(), for hydrate() to fill
+        # blocks in without clearing computed_hash on every field
+        cls.unhooked_class = super().__new__(mcs, name, (cls,), {'__slots__': (), '__setattr__': object.__setattr__})
+
+        if cls.block_type:
+            BLOCK_CLASSES[cls.block_type] = cls
+
+        return cls
+
+
+@lru_cache(maxsize=1024)
+def shared_decimal(val):
+    # Decimals are immutable, so blocks with the same value can share one
+    return Decimal(val)
+
+
 # Abstract
-class Block():
+class Block(metaclass=BlockMeta):
     block_type = None
     dict_props = ()
     
@@ -104,6 +160,26 @@ class Block():
     balance = Decimal('0.0')
     balance_delta = Decimal('0.0')
 
+    # generate_hash() of the fields as they were last hashed. Assigning any
+    # hashed field clears it, so dict fields (signal_data, refs) have to be
+    # replaced rather than changed in place, as update() does.
+    computed_hash = None
+
+    def __new__(cls, *args, **kwargs):
+        block = super().__new__(cls)
+
+        # Before any __init__, which subclasses may set fields in
+        for key, val in cls.slot_defaults.items():
+            setattr(block, key, val)
+
+        return block
+
+    def __setattr__(self, key, val):
+        object.__setattr__(self, key, val)
+
+        if key not in UNHASHED_FIELDS:
+            object.__setattr__(self, 'computed_hash', None)
+
     def __init__(self, deserialized_block=None):
         import time
         self.ts = int(time.time() * 1000)
@@ -111,14 +187,31 @@ class Block():
         if deserialized_block:
             self.deserialize(deserialized_block)
 
+    @classmethod
+    def hydrate(cls, serialized_block):
+        # A block read back from storage. Skips __init__, whose timestamps
+        # deserialize() would overwrite anyway, and is filled in as
+        # unhooked_class, which has nothing to clear yet.
+        unhooked_class = cls.unhooked_class
+        block = unhooked_class.__new__(unhooked_class)
+        block.deserialize(serialized_block)
+        block.__class__ = cls
+        return block
+
     def __repr__(self):
         return '<%s Hash=%s, Bal=%s>' % (self.__class__.__name__, self.block_hash, self.balance)
 
     def generate_hash(self, to_hash=None, assign=True):
-        if to_hash is not None:
-            assert type(to_hash) in (list, tuple)
-        else:
+        if to_hash is None and self.computed_hash is not None:
+            if assign:
+                self.block_hash = self.computed_hash
+            return self.computed_hash
+
+        own_hashable = to_hash is None
+        if own_hashable:
             to_hash = self.get_hashable()
+        else:
+            assert type(to_hash) in (list, tuple)
 
         from hashlib import sha256
         h = sha256()
@@ -134,6 +227,9 @@ class Block():
             h.update(hash_entry.encode('utf-8'))
 
         block_hash = h.hexdigest()
+        if own_hashable:
+            self.computed_hash = block_hash
+
         if assign:
             self.block_hash = block_hash
         return block_hash
@@ -169,7 +265,7 @@ class Block():
         self.height = int(serialized_block['height'])
         self.ts = int(serialized_block['ts'])
         self.balance = Decimal(serialized_block['balance'])
-        self.balance_delta = Decimal(serialized_block['balance_delta'])
+        self.balance_delta = shared_decimal(serialized_block['balance_delta'])
 
     def is_type(self, block_type):
         return self.block_type == block_type
@@ -179,7 +275,13 @@ class Block():
             raise Exception(f'Hash validation failed for block {self.block_hash}')
         return True
 
+    def clear_hash(self):
+        self.computed_hash = None
+
     def update(self, **kwargs):
+        # Subclasses set their own fields after this, before anything is hashed
+        self.clear_hash()
+
         self.block_hash = kwargs.get('block_hash', self.block_hash)
         self.prev_block_hash = kwargs.get('prev_block_hash', self.prev_block_hash)
         self.balance = Decimal(kwargs.get('balance', self.balance))
@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 
 import time
-from glom import glom
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
 
 from decimal import Decimal
 from collections import defaultdict
@@ -21,7 +24,13 @@ from blocks import BlockType, NullBlock, \
     Reset, Upgrade
 
 
-from blocks import BlockTypeMap
+from blocks import BlockTypeMap, BLOCK_CLASSES
+
+# Blocks carrying an activity_id, see Chain.activity_query()
+ACTIVITY_BLOCK_TYPES = (BlockType.SignalDelivered, BlockType.Action, BlockType.WorkOutput)
+from manifest import get_manifest
+from query import BlockQuery
+from credibility import CredibilityLedger, DEST_BLOCK_TYPES, SRC_BLOCK_TYPES, empty_stats
 
 class ChainSeed():
     val = None
@@ -73,10 +82,22 @@ class ChainInterface():
         if not amount or amount < 1 or type(amount) is not Decimal:
             amount = Decimal('1.00')
 
-        receive_signal_block = dest_chain.receive_signal(src_chain.uuid, send_signal_block_hash, signal_data, amount)
-        send_signal_reward_block = dest_chain.send_signal_reward(receive_signal_block, src_chain.uuid, amount)
-        receive_signal_reward_block = src_chain.receive_signal_reward(send_signal_reward_block.block_hash, dest_chain.uuid, amount)
-        src_chain.accept_credit(amount, ref_block_hash=receive_signal_reward_block.block_hash)
+        # Four blocks over two chains, written as one save per chain
+        with batch(src_chain, dest_chain):
+            receive_signal_block = dest_chain.receive_signal(src_chain.uuid, send_signal_block_hash, signal_data, amount)
+            send_signal_reward_block = dest_chain.send_signal_reward(src_chain.uuid, '', receive_signal_block.block_hash, amount)
+            receive_signal_reward_block = src_chain.receive_signal_reward(dest_chain.uuid, send_signal_reward_block.block_hash, amount)
+            src_chain.accept_credit(amount, ref_block_hash=receive_signal_reward_block.block_hash)
+
+
+# Files stored next to a chain as chain_<uuid>_<name>.json
+SIDECAR_NAMES = ('vcbidx', 'cred', 'verify', 'merkle')
+
+
+def is_sidecar(chain_file):
+    import os
+    stem = os.path.splitext(chain_file)[0]
+    return any(stem.endswith(f'_{name}') for name in SIDECAR_NAMES)
 
 
 class JSONLoader():
@@ -105,7 +126,14 @@ class JSONLoader():
 
         return chain['uuid'], chain['seed'], self.init_blocks(chain['blocks']), verification_close_idx
 
-    def save(self, chain_id, seed, blocks, verification_close_blocks):
+    def save(self, chain_id, seed, blocks, verification_close_blocks, full=False):
+        return self.commit(self.prepare(chain_id, seed, blocks, full=full), verification_close_blocks)
+
+    def prepare(self, chain_id, seed, blocks, full=False):
+        # The first half of save(): the chain written aside, swapped in by
+        # commit() or dropped by abort(). The whole file is rewritten on
+        # every save, so `full` changes nothing here.
+        import os
         import json
         serialized_blocks = [block.serialize() for block in blocks]
 
@@ -119,9 +147,30 @@ class JSONLoader():
             print(serialized_blocks)
             raise
 
-        with open(self.json_path, 'w') as f:
+        # Written aside and swapped in, so a failed save leaves the previous chain intact
+        tmp_path = f'{self.json_path}.tmp'
+        with open(tmp_path, 'w') as f:
             f.write(to_save)
+            f.flush()
+            os.fsync(f.fileno())
+
+        return tmp_path
+
+    def commit(self, tmp_path, verification_close_blocks):
+        import os
+        os.replace(tmp_path, self.json_path)
 
+        return self.save_index(verification_close_blocks)
+
+    def abort(self, tmp_path):
+        import os
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def save_index(self, verification_close_blocks):
+        import json
         serialized_close_blocks = {}
         for chain_id, block in verification_close_blocks.items():
             serialized_close_blocks[chain_id] = block.serialize()
@@ -141,106 +190,253 @@ class JSONLoader():
         path, ext = os.path.splitext(self.json_path)
         return os.path.join('%s%s%s' % (path, '_vcbidx', ext))
 
+    def delete(self):
+        # The chain file and every sidecar of it (see SIDECAR_NAMES)
+        import os
+        os.remove(self.json_path)
+
+        for name in SIDECAR_NAMES:
+            try:
+                os.remove(self.sidecar_path(name))
+            except FileNotFoundError:
+                pass
+
+    def sidecar_path(self, name):
+        import os
+        path, ext = os.path.splitext(self.json_path)
+        return f'{path}_{name}.json'
+
+    def load_sidecar(self, name):
+        # Sidecars hold derived data, so a missing or unreadable one just means "rebuild it"
+        import json
+        try:
+            with open(self.sidecar_path(name), 'r') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def save_sidecar(self, name, data):
+        import os
+        import json
+
+        sidecar_path = self.sidecar_path(name)
+        with open(f'{sidecar_path}.tmp', 'w') as f:
+            f.write(json.dumps(data))
+
+        os.replace(f'{sidecar_path}.tmp', sidecar_path)
+
     def init_blocks(self, blocks):
         result = []
+        append = result.append
+        block_classes = BLOCK_CLASSES
+
+        # Strings repeated across blocks are kept once: each prev_block_hash
+        # is the previous block's hash, and counterparties recur throughout
+        chain_ids = {}
+        prev_hash = None
 
         for serialized_block in blocks:
-            result.append(self.init_block(serialized_block))
+            block_class = block_classes.get(serialized_block['block_type'])
+            if not block_class:
+                raise Exception('Unknown block encountered', serialized_block)
+
+            block = block_class.hydrate(serialized_block)
+
+            if block.prev_block_hash == prev_hash:
+                block.prev_block_hash = prev_hash
+
+            for attr in ('src_chain_id', 'dest_chain_id'):
+                chain_id = getattr(block, attr, None)
+                if chain_id:
+                    setattr(block, attr, chain_ids.setdefault(chain_id, chain_id))
+
+            append(block)
+            prev_hash = block.block_hash
 
         return result
 
     def init_block(self, serialized_block):
-        block_type = serialized_block['block_type']
+        block_class = BLOCK_CLASSES.get(serialized_block['block_type'])
+        if not block_class:
+            raise Exception('Unknown block encountered', serialized_block)
+
+        return block_class.hydrate(serialized_block)
 
-        if block_type == BlockType.SignalSent:
-            return SignalSent(serialized_block)
 
-        elif block_type == BlockType.SignalReceived:
-            return SignalReceived(serialized_block)
+class LogLoader(JSONLoader):
+    # Append-only storage: a header line holding the chain uuid and seed, then
+    # one serialized block per line. A save only appends the blocks added since
+    # the last load/save, and falls back to rewriting the log when the blocks
+    # already on disk were changed (deleted, rehashed, ...).
 
-        elif block_type == BlockType.SignalDelivered:
-            return SignalDelivered(serialized_block)
+    def __init__(self, log_path):
+        super().__init__(log_path)
 
-        elif block_type == BlockType.SignalRewardSent:
-            return SignalRewardSent(serialized_block)
+        self.num_persisted = 0
+        self.head_hash = None
+        self.close_block_hashes = None
 
-        elif block_type == BlockType.SignalRewardReceived:
-            return SignalRewardReceived(serialized_block)
+        # Bytes of the log up to the end of the last whole block, see save()
+        self.persisted_length = None
 
-        elif block_type == BlockType.Action:
-            return Action(serialized_block)
+    @staticmethod
+    def create(log_path, chain_uuid, seed):
+        import json
+        header = json.dumps({'uuid': str(chain_uuid), 'seed': str(seed)}) + '\n'
+        with open(log_path, 'x') as f:
+            f.write(header)
 
-        elif block_type == BlockType.WorkOutput:
-            return WorkOutput(serialized_block)
+        loader = LogLoader(log_path)
+        loader.persisted_length = len(header.encode('utf-8'))
 
-        elif block_type == BlockType.Debit:
-            return Debit(serialized_block)
+        return loader
 
-        elif block_type == BlockType.Credit:
-            return Credit(serialized_block)
+    def load(self):
+        import json
 
-        elif block_type == BlockType.CreditAccepted:
-            return CreditAccepted(serialized_block)
+        with open(self.json_path, 'rb') as f:
+            lines = f.readlines()
 
-        elif block_type == BlockType.CreditRejected:
-            return CreditRejected(serialized_block)
+        if not lines or not lines[0].endswith(b'\n'):
+            raise Exception(f'Chain log has no header: {self.json_path}')
 
-        elif block_type == BlockType.TargetCreated:
-            return TargetCreated(serialized_block)
+        header = json.loads(lines[0])
 
-        elif block_type == BlockType.TargetAccepted:
-            return TargetAccepted(serialized_block)
+        serialized_blocks = []
+        valid_length = len(lines[0])
+        for line_num, line in enumerate(lines[1:], start=2):
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('Unterminated line')
+                serialized_blocks.append(json.loads(line))
+            except ValueError:
+                if line_num != len(lines):
+                    raise Exception(f'Chain log corrupted at line {line_num}: {self.json_path}')
+
+                # A crash mid-append leaves a torn final line, or another
+                # thread or process is appending right now. Everything before it
+                # was fully written, so skip it here; it's cut off by the next
+                # save(), which holds the chain's lock.
+                print(f'Skipping torn block at line {line_num} of {self.json_path}')
+                break
+            else:
+                valid_length += len(line)
 
-        elif block_type == BlockType.TargetRewardClaimSent:
-            return TargetRewardClaimSent(serialized_block)
+        blocks = self.init_blocks(serialized_blocks)
 
-        elif block_type == BlockType.TargetRewardClaimReceived:
-            return TargetRewardClaimReceived(serialized_block)
+        verification_close_idx = {}
+        try:
+            with open(self.index_path(), 'r') as f:
+                index = json.loads(f.read())
+        except:
+            pass
+        else:
+            for chain_uuid, serialized_block in index['verification_close_blocks'].items():
+                verification_close_idx[chain_uuid] = self.init_block(serialized_block)
 
-        elif block_type == BlockType.TargetRewardSent:
-            return TargetRewardSent(serialized_block)
+        self.num_persisted = len(blocks)
+        self.head_hash = blocks[-1].block_hash if blocks else None
+        self.close_block_hashes = self.get_close_block_hashes(verification_close_idx)
+        self.persisted_length = valid_length
 
-        elif block_type == BlockType.TargetRewardReceived:
-            return TargetRewardReceived(serialized_block)
+        return header['uuid'], header['seed'], blocks, verification_close_idx
 
-        elif block_type == BlockType.WorkOutputRewardSent:
-            return WorkOutputRewardSent(serialized_block)
+    def prepare(self, chain_id, seed, blocks, full=False):
+        # A rewritten log is written aside here; appended blocks are only
+        # serialized, commit() writes them
+        import json
 
-        elif block_type == BlockType.WorkOutputRewardReceived:
-            return WorkOutputRewardReceived(serialized_block)
+        pending = {
+            'tmp_path': None,
+            'length': None,
+            'to_append': None,
+            'num_blocks': len(blocks),
+            'head_hash': blocks[-1].block_hash if blocks else None,
+        }
 
-        elif block_type == BlockType.AccessContractOwn:
-            return AccessContractOwn(serialized_block)
+        if full or not self.is_appendable(blocks):
+            pending['tmp_path'], pending['length'] = self.write_aside(chain_id, seed, blocks)
+        else:
+            new_blocks = blocks[self.num_persisted:]
+            if new_blocks:
+                pending['to_append'] = ''.join(json.dumps(block.serialize()) + '\n' for block in new_blocks)
 
-        elif block_type == BlockType.AccessContractOther:
-            return AccessContractOther(serialized_block)
+        return pending
 
-        elif block_type == BlockType.AccessContractOwnEventAsk:
-            return AccessContractOwnEventAsk(serialized_block)
+    def commit(self, pending, verification_close_blocks):
+        import os
 
-        elif block_type == BlockType.AccessContractOtherEventOpen:
-            return AccessContractOtherEventOpen(serialized_block)
+        if pending['tmp_path']:
+            os.replace(pending['tmp_path'], self.json_path)
+            self.persisted_length = pending['length']
+        elif pending['to_append']:
+            to_save = pending['to_append']
+
+            # A torn block left by a crashed append goes before appending
+            length = os.path.getsize(self.json_path)
+            if self.persisted_length is not None and length > self.persisted_length:
+                print(f'Discarding torn block at the end of {self.json_path}')
+                os.truncate(self.json_path, self.persisted_length)
+                length = self.persisted_length
+
+            # All new blocks go out in one write; if it fails part way, cut the
+            # log back so none of them are kept
+            try:
+                with open(self.json_path, 'a') as f:
+                    f.write(to_save)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except:
+                os.truncate(self.json_path, length)
+                raise
 
-        elif block_type == BlockType.AccessContractOtherEventClose:
-            return AccessContractOtherEventClose(serialized_block)
+            self.persisted_length = length + len(to_save.encode('utf-8'))
 
-        elif block_type == BlockType.VerificationOpen:
-            return VerificationOpen(serialized_block)
+        self.num_persisted = pending['num_blocks']
+        self.head_hash = pending['head_hash']
 
-        elif block_type == BlockType.Verification:
-            return Verification(serialized_block)
+        close_block_hashes = self.get_close_block_hashes(verification_close_blocks)
+        if close_block_hashes != self.close_block_hashes:
+            self.save_index(verification_close_blocks)
+            self.close_block_hashes = close_block_hashes
 
-        elif block_type == BlockType.VerificationClose:
-            return VerificationClose(serialized_block)
+        return True
 
-        elif block_type == BlockType.Reset:
-            return Reset(serialized_block)
+    def is_appendable(self, blocks):
+        if len(blocks) < self.num_persisted:
+            return False
 
-        elif block_type == BlockType.Upgrade:
-            return Upgrade(serialized_block)
+        if self.num_persisted == 0:
+            return True
 
-        else:
-            raise Exception('Unknown block encountered', serialized_block)
+        return blocks[self.num_persisted - 1].block_hash == self.head_hash
+
+    def abort(self, pending):
+        if pending['tmp_path']:
+            super().abort(pending['tmp_path'])
+
+    def write_aside(self, chain_id, seed, blocks):
+        import os
+        import json
+
+        tmp_path = f'{self.json_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'uuid': str(chain_id), 'seed': str(seed)}) + '\n')
+            for block in blocks:
+                f.write(json.dumps(block.serialize()) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            length = f.tell()
+
+        return tmp_path, length
+
+    def index_path(self):
+        import os
+        path, ext = os.path.splitext(self.json_path)
+        return f'{path}_vcbidx.json'
+
+    def get_close_block_hashes(self, verification_close_blocks):
+        return {chain_id: block.block_hash for chain_id, block in verification_close_blocks.items()}
 
 
 class Chain():
@@ -253,12 +449,51 @@ class Chain():
     data = None
     interface = None
 
+    # Bumped on every save, lets ChainCache tell our own writes from foreign ones
+    write_version = 0
+
     def __init__(self, interface, loader):
         # Dependency injection
         self.interface = interface
         self.loader = loader
         self.verification_close_block_index = {}
 
+        # block_hash -> position in self.blocks, see ensure_index()
+        self.block_hash_index = {}
+        # block_type -> ascending positions in self.blocks
+        self.block_type_index = {}
+        # counterparty chain id (src_chain_id/dest_chain_id) -> ascending positions
+        self.peer_index = {}
+        # block_type -> (timestamps, positions), both ordered by (ts, position)
+        self.block_ts_index = {}
+        # activity_id -> [(ts, position, block_type)] in that order, see ACTIVITY_BLOCK_TYPES
+        self.activity_index = {}
+        # block_hash -> [(position, field)] of the blocks referencing it, see Block.ref_fields
+        self.ref_index = {}
+        # (Verification or VerificationClose, counterparty chain id) -> ascending positions
+        self.verification_index = {}
+        self.indexed_length = 0
+        self.index_dirty = True
+
+        # Loaded on first use, see get_credibility_ledger()
+        self.credibility = None
+        # (height, head_hash) of the ledger as last written, see save_credibility()
+        self.credibility_saved = None
+
+        # Verified-through checkpoint, loaded on first use, see get_verified_height()
+        self.verified = None
+        self.verified_dirty = False
+
+        # Verification/VerificationClose block hash -> Merkle root of its
+        # sub-chain, loaded on first use, see commit_merkle_root()
+        self.merkle_roots = None
+        self.merkle_roots_dirty = False
+
+        # Saves requested inside batch() are held back until it exits
+        self.batch_depth = 0
+        self.save_pending = False
+        self.save_pending_full = False
+
         try:
             self.load(loader)
         except Exception as e:
@@ -266,8 +501,13 @@ class Chain():
             raise Exception(f'Failed to load chain from {loader.json_path}')
 
     def delete(self):
+        self.loader.delete()
+        chain_cache.discard(self.uuid)
+        self.get_manifest().remove(self.uuid)
+
+    def get_manifest(self):
         import os
-        os.remove(self.loader.json_path)
+        return get_manifest(os.path.dirname(self.loader.json_path))
 
     def load(self, loader=None):
         if not loader:
@@ -281,90 +521,331 @@ class Chain():
 
         self.verification_close_block_index = verification_close_block_index
 
+        # Built on first lookup
+        self.invalidate_index()
+        self.credibility = None
+        self.credibility_saved = None
+        self.verified = None
+        self.verified_dirty = False
+        self.merkle_roots = None
+        self.merkle_roots_dirty = False
+
         return True
 
-    def save(self, loader=None):
-        return self.loader.save(self.uuid, self.seed, self.blocks, self.verification_close_block_index)
+    def save(self, loader=None, full=False):
+        # full=True forces a complete rewrite; needed after blocks already on disk were changed in place.
+        if not loader:
+            if self.batch_depth:
+                self.save_pending = True
+                self.save_pending_full = self.save_pending_full or full
+                return True
+
+            loader = self.loader
+
+        # Writers to the log hold the chain's lock, see LogLoader.commit()
+        with lock_chains(self.uuid):
+            pending = loader.prepare(self.uuid, self.seed, self.blocks, full=full)
+            try:
+                return self.commit_save(loader, pending)
+            except BaseException:
+                loader.abort(pending)
+                raise
+
+    def commit_save(self, loader, pending):
+        # The second half of save(), see flush_batches()
+        with lock_chains(self.uuid):
+            result = loader.commit(pending, self.verification_close_block_index)
+            self.write_version += 1
+
+            self.get_manifest().update(self.get_summary())
+
+            if self.verified_dirty:
+                loader.save_sidecar('verify', self.verified)
+                self.verified_dirty = False
+
+            if self.merkle_roots_dirty:
+                loader.save_sidecar('merkle', self.merkle_roots)
+                self.merkle_roots_dirty = False
+
+        return result
+
+    @contextmanager
+    def batch(self):
+        # Group several block additions into one write: save() calls made
+        # inside are deferred and the chain is saved once when the outermost
+        # batch exits. If the batch raises, nothing is saved and the chain is
+        # reloaded from disk, dropping everything added during the batch.
+        with lock_chains(self.uuid):
+            self.batch_depth += 1
+            if self.batch_depth == 1:
+                begin_length = len(self.blocks)
+                self.save_pending = False
+                self.save_pending_full = False
+
+            try:
+                yield self
+            except BaseException:
+                if self.batch_depth == 1 and (self.save_pending or len(self.blocks) != begin_length):
+                    self.save_pending = False
+                    self.load()
+                raise
+            finally:
+                self.batch_depth -= 1
+
+            if not self.batch_depth:
+                if self.save_pending:
+                    self.save_pending = False
+                    try:
+                        self.save(full=self.save_pending_full)
+                    except BaseException:
+                        self.load()
+                        raise
+
+                self.save_credibility()
 
     def get_block_by_hash(self, block_hash):
-        for block in self.blocks:
-            if block.block_hash == block_hash:
-                return block
+        idx = self.get_block_idx_by_hash(block_hash)
+        if idx is not None:
+            return self.blocks[idx]
 
     def get_block_idx_by_hash(self, block_hash):
-        for i, block in enumerate(self.blocks):
-            if block.block_hash == block_hash:
-                return i
+        self.ensure_index()
+
+        idx = self.block_hash_index.get(block_hash)
+        if idx is not None and self.blocks[idx].block_hash != block_hash:
+            # A block was rehashed without invalidate_index()
+            self.reindex()
+            idx = self.block_hash_index.get(block_hash)
+
+        return idx
+
+    def invalidate_index(self):
+        # Call after changing self.blocks other than through add_block()
+        # (deleting, reordering or rehashing blocks). The index is rebuilt on next use.
+        self.index_dirty = True
+
+        # An edit may not change any hash, so the ledger can't tell; replay it,
+        # and write the replayed one even if it ends on the same head
+        self.credibility = CredibilityLedger()
+        self.credibility_saved = None
+
+        # Same for the verify checkpoint; dropped on disk with the next save
+        self.verified = {'height': 0, 'head_hash': None}
+        self.verified_dirty = True
+
+    def ensure_index(self):
+        if self.index_dirty or self.indexed_length != len(self.blocks):
+            self.reindex()
+
+    def reindex(self):
+        # Readers reindex too, so this takes the lock add_block()'s writers hold
+        with lock_chains(self.uuid):
+            self.block_hash_index = {}
+            self.block_type_index = {}
+            self.peer_index = {}
+            self.block_ts_index = {}
+            self.activity_index = {}
+            self.ref_index = {}
+            self.verification_index = {}
+
+            for idx, block in enumerate(self.blocks):
+                self.index_block(block, idx)
+
+            self.indexed_length = len(self.blocks)
+            self.index_dirty = False
+
+    def index_block(self, block, idx):
+        # First occurrence wins, same as the old linear scan
+        self.block_hash_index.setdefault(block.block_hash, idx)
+
+        positions = self.block_type_index.get(block.block_type)
+        if positions is None:
+            positions = self.block_type_index[block.block_type] = array('q')
+        positions.append(idx)
+
+        ts_index = self.block_ts_index.get(block.block_type)
+        if ts_index is None:
+            ts_index = self.block_ts_index[block.block_type] = (array('q'), array('q'))
+
+        # Timestamps are nearly always in chain order, so this is nearly always an append
+        timestamps, positions = ts_index
+        ts = block.ts or 0
+        if not timestamps or ts >= timestamps[-1]:
+            timestamps.append(ts)
+            positions.append(idx)
+        else:
+            i = bisect_right(timestamps, ts)
+            timestamps.insert(i, ts)
+            positions.insert(i, idx)
+
+        if block.block_type in ACTIVITY_BLOCK_TYPES and block.activity_id:
+            entries = self.activity_index.get(block.activity_id)
+            if entries is None:
+                entries = self.activity_index[block.activity_id] = []
+
+            entry = (ts, idx, block.block_type)
+            if not entries or entry > entries[-1]:
+                entries.append(entry)
+            else:
+                insort(entries, entry)
+
+        for field in block.ref_fields:
+            ref_block_hash = getattr(block, field)
+            if ref_block_hash:
+                refs = self.ref_index.get(ref_block_hash)
+                if refs is None:
+                    refs = self.ref_index[ref_block_hash] = []
+                refs.append((idx, field))
+
+        peer_chain_id = getattr(block, 'src_chain_id', None) or getattr(block, 'dest_chain_id', None)
+        if peer_chain_id:
+            positions = self.peer_index.get(peer_chain_id)
+            if positions is None:
+                positions = self.peer_index[peer_chain_id] = array('q')
+            positions.append(idx)
+
+            if block.block_type in (BlockType.Verification, BlockType.VerificationClose):
+                key = (block.block_type, peer_chain_id)
+                positions = self.verification_index.get(key)
+                if positions is None:
+                    positions = self.verification_index[key] = array('q')
+                positions.append(idx)
+
+    def get_block_positions(self, block_type):
+        # Ascending positions of the blocks of block_type, or of any of a
+        # list of types. Not a copy, don't modify it.
+        self.ensure_index()
+
+        if type(block_type) in (list, tuple, set):
+            all_positions = [self.block_type_index[t] for t in set(block_type) if t in self.block_type_index]
+            if len(all_positions) == 1:
+                return all_positions[0]
+
+            return array('q', heapq.merge(*all_positions))
+
+        return self.block_type_index.get(block_type, array('q'))
+
+    def get_block_positions_in_window(self, block_type, window_far=None, window_near=None):
+        # Positions of the blocks of block_type, or of any of a list of types,
+        # with window_far <= ts <= window_near, in timestamp order
+        self.ensure_index()
+
+        block_types = set(block_type) if type(block_type) in (list, tuple, set) else [block_type]
+
+        ranges = []
+        for block_type in block_types:
+            ts_index = self.block_ts_index.get(block_type)
+            if ts_index is None:
+                continue
 
-    def block_query(self, block_type, attr_query=None, window_far=None, window_near=None, multiple=False):
-        if type(block_type) is list:
-            multiple = True
+            timestamps, positions = ts_index
+            begin = bisect_left(timestamps, window_far) if window_far is not None else 0
+            end = bisect_right(timestamps, window_near) if window_near is not None else len(timestamps)
 
-        type_map = {
-            'str': str,
-            'int': int,
-            'decimal': Decimal,
-            'dict': dict,
-        }
+            ranges.append(zip(timestamps[begin:end], positions[begin:end]))
 
-        result = []
-        for block in self.blocks:
-            block_matched = None
+        return [idx for ts, idx in heapq.merge(*ranges)]
 
-            if window_far or window_near:
-                ts = block.ts
-                if not ts:
-                    continue
+    def get_activity_positions(self, activity_id, block_type=None, window_far=None, window_near=None):
+        # Positions of the activity's blocks, optionally only those of
+        # block_type (or any of a list of types) with window_far <= ts <= window_near,
+        # in timestamp order. Only ACTIVITY_BLOCK_TYPES are indexed.
+        self.ensure_index()
 
-                if window_far and ts < window_far:
-                    continue
+        entries = self.activity_index.get(activity_id)
+        if not entries:
+            return []
 
-                if window_near and ts > window_near:
-                    continue
+        begin = bisect_left(entries, (window_far,)) if window_far is not None else 0
+        end = bisect_left(entries, (window_near + 1,)) if window_near is not None else len(entries)
 
-            if type(block_type) is list:
-                if block.block_type not in block_type:
-                    continue
+        if block_type is None:
+            return [idx for ts, idx, _ in entries[begin:end]]
 
-            elif block.block_type != block_type:
-                continue
+        block_types = set(block_type) if type(block_type) in (list, tuple, set) else (block_type,)
 
-            if attr_query:
-                query_key = attr_query['key']
-                query_subkey = attr_query.get('subkey')
-                query_value = attr_query['value']
-                query_value_type = attr_query['value_type']
+        return [idx for ts, idx, entry_type in entries[begin:end] if entry_type in block_types]
 
-                if not hasattr(block, query_key):
-                    continue
+    def activity_query(self, activity_id, block_type=None, window_far=None, window_near=None):
+        blocks = self.blocks
+        return [blocks[idx] for idx in self.get_activity_positions(activity_id, block_type, window_far, window_near)]
 
-                current_value = getattr(block, query_key)
+    def get_refs(self, block):
+        # (field, block_hash, block) for every block this one references;
+        # block is None when it isn't on this chain (e.g. the other chain's half)
+        refs = []
+        for field in block.ref_fields:
+            ref_block_hash = getattr(block, field)
+            if ref_block_hash:
+                refs.append((field, ref_block_hash, self.get_block_by_hash(ref_block_hash)))
 
-                if query_subkey and query_key in block.dict_props:
-                    try:
-                        if '.' in query_subkey:
-                            current_value = glom(current_value, query_subkey)
-                        else:
-                            current_value = current_value[query_subkey]
-                    except:
-                        pass
-
-                if type(current_value) != type_map[query_value_type]:
-                    continue
+        return refs
 
-                if current_value == query_value:
-                    block_matched = True
+    def get_referencing_positions(self, block_hash, field=None):
+        # Ascending positions of the blocks referencing block_hash, through field if given
+        self.ensure_index()
 
-            else:
-                block_matched = True
+        return [idx for idx, ref_field in self.ref_index.get(block_hash, []) if not field or ref_field == field]
 
-            if block_matched:
-                if multiple:
-                    result.append(block)
-                else:
-                    return block
+    def get_indexed_block_types(self):
+        self.ensure_index()
 
-        return result
+        return list(self.block_type_index.keys())
+
+    def get_referencing_blocks(self, block_hash):
+        # (field, block) for every block on this chain referencing block_hash, in chain order
+        self.ensure_index()
+
+        return [(field, self.blocks[idx]) for idx, field in self.ref_index.get(block_hash, [])]
+
+    def get_peer_positions(self, chain_id):
+        # Ascending positions of the blocks whose src_chain_id or
+        # dest_chain_id is chain_id. Not a copy, don't modify it.
+        self.ensure_index()
+
+        return self.peer_index.get(chain_id, array('q'))
+
+    def get_blocks_by_type(self, block_type):
+        blocks = self.blocks
+        return [blocks[idx] for idx in self.get_block_positions(block_type)]
+
+    def find_last_block(self, positions, match, begin_idx=None):
+        # Newest of the blocks at positions, at or before begin_idx, for which
+        # match(block) holds, as (block, idx); (None, None) if there is none
+        end = len(positions)
+        if begin_idx is not None:
+            end = bisect_right(positions, begin_idx)
+
+        for i in range(end - 1, -1, -1):
+            block = self.blocks[positions[i]]
+            if match(block):
+                return block, positions[i]
+
+        return None, None
+
+    def block_query(self, block_type=None, attr_query=None, window_far=None, window_near=None, multiple=False,
+                    predicates=None, offset=0, newest_first=False):
+        # First matching block, or all of them (a list) with multiple=True.
+        # See query.BlockQuery for predicates and query_blocks() for paging.
+        if type(block_type) is list:
+            multiple = True
+
+        query = BlockQuery(block_type, predicates, attr_query, window_far, window_near)
+        result, next_cursor = query.run(self, limit=None if multiple else 1, offset=offset, newest_first=newest_first)
+
+        if multiple:
+            return result
+        elif result:
+            return result[0]
+
+        return []
+
+    def query_blocks(self, block_type=None, predicates=None, attr_query=None, window_far=None, window_near=None,
+                     limit=None, offset=0, cursor=None, newest_first=False):
+        # One page of matching blocks and the cursor for the next page (None on the last one)
+        query = BlockQuery(block_type, predicates, attr_query, window_far, window_near)
+
+        return query.run(self, limit=limit, offset=offset, cursor=cursor, newest_first=newest_first)
 
     def send_signal(self, dest_chain_id, signal_data, amount=None):
         block = SignalSent()
@@ -377,7 +858,7 @@ class Chain():
         self.save()
 
         if self.interface:
-            self.interface.send_signal(self.uuid, dest_chain_id, block.block_hash, signal_data, amount=amount)
+            self.interface.send_signal(self, dest_chain_id, block.block_hash, signal_data, amount=amount)
 
         return block
 
@@ -822,13 +1303,36 @@ class Chain():
         block.prev_block_hash = prev_block_hash
         block.height = height
         block.balance = balance
+        block.clear_hash()
         block.generate_hash()
 
-        self.blocks.append(block)
+        # Held so a reader's reindex() or ledger catch-up can't count the block twice
+        with lock_chains(self.uuid):
+            self.blocks.append(block)
+
+            if not self.index_dirty and self.indexed_length == len(self.blocks) - 1:
+                self.index_block(block, len(self.blocks) - 1)
+                self.indexed_length += 1
+
+            if self.credibility is not None and self.credibility.height == len(self.blocks) - 1:
+                self.credibility.apply(block, self.get_block_by_hash)
 
         if block.block_type == BlockType.VerificationClose:
             self.index_verification_close_block(block)
 
+    def get_height_range(self, from_height=None, to_height=None):
+        # (begin, end) positions of the blocks with from_height <= height <= to_height.
+        # Heights ascend along the chain, so this is a bisect.
+        begin = 0
+        end = len(self.blocks)
+
+        if from_height is not None:
+            begin = bisect_left(self.blocks, from_height, key=lambda block: block.height)
+        if to_height is not None:
+            end = bisect_right(self.blocks, to_height, key=lambda block: block.height)
+
+        return begin, max(begin, end)
+
     def head_block(self):
         if not self.blocks:
             return NullBlock()
@@ -838,50 +1342,84 @@ class Chain():
     def balance(self):
         return self.head_block().balance
 
-    def make_valid(self):
+    def make_valid(self, dry_run=False):
         # Restore local integrity to the chain.
         #   Cannot fix references to other chains.
         #   Cannot fix problems in contained data.
+        #
+        # One pass: from the first block that fails verify() onwards, every
+        # block is relinked to the one before it, its balance recomputed and
+        # it is rehashed. Returns what was changed; with dry_run=True the
+        # chain is left alone and the same report is the repair plan.
+        import copy
 
-        result = self.find_invalid()
-        if result is True:
-            return True
-        else:
-            invalid_block, idx = result
+        repairs = []
+        first_invalid_idx = None
 
-        max_iterations = len(self.blocks)
-        i = 0
+        prev_block_hash = self.generate_seed_hash()
+        balance = NullBlock().balance
 
-        while i <= max_iterations:
-            i += 1
+        for idx, block in enumerate(self.blocks):
+            if first_invalid_idx is None:
+                if block.prev_block_hash != prev_block_hash or block.block_hash != block.generate_hash(assign=False):
+                    first_invalid_idx = idx
+
+            if first_invalid_idx is not None:
+                old_block = copy.copy(block)
+                if dry_run:
+                    block = copy.copy(block)
+
+                # Same as add_block()
+                if block.balance_delta != 0:
+                    balance += block.balance_delta
+
+                block.prev_block_hash = prev_block_hash
+                block.balance = balance
+                block.clear_hash()
+                block.generate_hash()
+
+                changes = {}
+                for attr in ('prev_block_hash', 'balance', 'block_hash'):
+                    old_val, new_val = getattr(old_block, attr), getattr(block, attr)
+                    if str(old_val) != str(new_val):
+                        changes[attr] = [str(old_val), str(new_val)]
+
+                if changes:
+                    repairs.append({
+                        'Index': idx,
+                        'BlockHash': old_block.block_hash,
+                        'Changes': changes,
+                    })
 
-            prev_block = self.blocks[idx - 1]
+            prev_block_hash = block.block_hash
+            balance = block.balance
 
-            invalid_block.balance = prev_block.balance + invalid_block.balance_delta
-            invalid_block.prev_block_hash = prev_block.block_hash
-            invalid_block.generate_hash()
+        if repairs and not dry_run:
+            self.invalidate_index()
 
-            # Efficiency be damned: verify() starts from the beginning each time.
-            result = self.find_invalid()
-            if result is True:
-                return True
-            else:
-                next_invalid_block, next_idx = result
-                if next_invalid_block == invalid_block:
-                    print('Rebuild failed', next_invalid_block, invalid_block)
-                    raise Exception(f'Rebuild failed on block {invalid_block.block_hash}, idx={idx}')
-                else:
-                    invalid_block = next_invalid_block
-                    idx = next_idx
+        return {
+            'Valid': first_invalid_idx is None,
+            'FirstInvalidIndex': first_invalid_idx,
+            'DryRun': dry_run,
+            'Repairs': repairs,
+        }
 
-        return False
+    def verify(self, quiet=True, exc=True, incremental=False, workers=None):
+        # incremental=True only checks the blocks added since the last
+        # successful verify, see get_verified_height()
+        begin_idx = self.get_verified_height() if incremental else 0
+
+        # Blocks added while this runs (verify isn't locked) aren't checked,
+        # so they mustn't count as verified either
+        end = len(self.blocks)
+
+        if workers:
+            self.prehash(workers, begin_idx)
 
-    def verify(self, quiet=True, exc=True):
-        
         # Iterate blocks from bottom (head, newest) to top (tail, oldest)
 
         next_block_hash = None
-        for idx in range(len(self.blocks) - 1, -1, -1):
+        for idx in range(end - 1, begin_idx - 1, -1):
             block = self.blocks[idx]
 
             if next_block_hash:
@@ -918,12 +1456,63 @@ class Chain():
             if not quiet:
                 print('Block %d valid' % idx)
 
+        if begin_idx and next_block_hash and next_block_hash != self.blocks[begin_idx - 1].block_hash:
+            # The new blocks don't link up with the verified ones
+            block = self.blocks[begin_idx - 1]
+            msg = f'Chain verification failed on block {block.block_hash} ({begin_idx - 1})'
+            if exc:
+                raise Exception(msg)
+            else:
+                print(msg)
+                print(next_block_hash, block.block_hash)
+                return block, begin_idx - 1
+
+        self.set_verified_height(end)
+
         return True
 
-    def find_invalid(self):
+    def get_verified_height(self):
+        # Number of leading blocks a previous verify() found valid. The
+        # checkpoint is only used while the block it ends on still has the
+        # hash it had then; in-process edits reset it via invalidate_index().
+        if self.verified is None:
+            self.verified = self.loader.load_sidecar('verify') or {'height': 0, 'head_hash': None}
+
+        height = self.verified['height']
+        if 0 < height <= len(self.blocks) and self.blocks[height - 1].block_hash == self.verified['head_hash']:
+            return height
+
+        return 0
+
+    def set_verified_height(self, height):
+        verified = {
+            'height': height,
+            'head_hash': self.blocks[height - 1].block_hash if height else None
+        }
+
+        if verified != self.verified:
+            self.verified = verified
+            self.verified_dirty = False
+
+            with lock_chains(self.uuid):
+                self.loader.save_sidecar('verify', verified)
+
+    def prehash(self, workers=None, begin_idx=0):
+        # Hash the blocks over worker processes ahead of a verify()/find_invalid(),
+        # which then finds them already hashed. See verify.hash_blocks().
+        from verify import hash_blocks
+
+        # Held so no block changes between the workers hashing it and its hash being kept
+        with lock_chains(self.uuid):
+            return hash_blocks(self.blocks, begin_idx, workers)
+
+    def find_invalid(self, workers=None):
         # Find the earliest invalid block
         # Iterate blocks from top (tail, oldest) to bottom (head, newest)
 
+        if workers:
+            self.prehash(workers)
+
         prev_block_hash = None
         for idx, block in enumerate(self.blocks):
             # Own hash matches
@@ -954,8 +1543,9 @@ class Chain():
         }
 
         block_list = []
-        for block in self.blocks:
-            if block.block_type not in linked_blocks.keys():
+        for idx in self.get_peer_positions(other_chain_id):
+            block = self.blocks[idx]
+            if block.block_type not in linked_blocks:
                 continue
 
             if block.block_type in (BlockType.SignalSent, BlockType.SignalRewardSent):
@@ -995,13 +1585,9 @@ class Chain():
             # Find all the pairs by intersecting what this chain knows with what the other chain knows.
             mapped_blocks = set(self_sig_rec_block_ids) & set(other_sig_sent_block_ids)
 
-            print(sorted(list(self_sig_rec_block_ids)))
-            print(sorted(list(other_sig_sent_block_ids)))
-
             # If there is a different amount of pairs than what we know about, it's a problem
             if len(mapped_blocks) != num_sig_rec_blocks:
-                print(len(mapped_blocks), num_sig_rec_blocks)
-                print(sorted(mapped_blocks), sorted(self_sig_rec_block_ids))
+                print(f'{len(mapped_blocks)} of {num_sig_rec_blocks} signals received on {self.uuid} were sent by {other_chain.uuid}')
                 raise Exception('Signal verification failed')
         else:
             if not quiet:
@@ -1025,59 +1611,57 @@ class Chain():
         print(f'Cross-verification from chain {self.uuid} to chain {other_chain.uuid} succeeded')
         return True
 
-    def get_verification_block(self, src_chain_id, begin_idx=None):
-        verification_block = None
-
-        if begin_idx is None:
-            begin_idx = len(self.blocks) - 1
-
-        # Iterate from top to bottom
-        for idx in range(begin_idx, -1, -1):
-            block = self.blocks[idx]
-            if block.block_type == BlockType.Verification:
-                if block.src_chain_id == src_chain_id:
-                    verification_block = block
-                    break
+    def get_verification_positions(self, block_type, chain_id):
+        # Ascending positions of the Verification (src_chain_id) or
+        # VerificationClose (dest_chain_id) blocks for chain_id. Not a copy.
+        self.ensure_index()
 
-        if not verification_block:
-            idx = None
+        return self.verification_index.get((block_type, chain_id), array('q'))
 
-        return verification_block, idx
+    def get_verification_block(self, src_chain_id, begin_idx=None):
+        return self.find_last_block(
+            self.get_verification_positions(BlockType.Verification, src_chain_id),
+            lambda block: True,
+            begin_idx
+        )
 
     def get_verification_close_block(self, dest_chain_id, begin_idx=None):
-        verification_block = None
-
-        if begin_idx is None:
-            begin_idx = len(self.blocks) - 1
+        return self.find_last_block(
+            self.get_verification_positions(BlockType.VerificationClose, dest_chain_id),
+            lambda block: True,
+            begin_idx
+        )
 
-        # Iterate from top to bottom
-        for idx in range(begin_idx, -1, -1):
-            block = self.blocks[idx]
-            if block.block_type == BlockType.VerificationClose:
-                if block.dest_chain_id == dest_chain_id:
-                    verification_block = block
-                    break
+    def get_verification_close_blocks(self, ignore_chain_id=None):
+        close_blocks = []
+        for block in self.get_blocks_by_type(BlockType.VerificationClose):
+            if not ignore_chain_id or block.dest_chain_id != ignore_chain_id:
+                close_blocks.append(block)
 
-        if not verification_block:
-            idx = None
+        return close_blocks
 
-        return verification_block, idx
+    def get_latest_verification_close_blocks(self, ignore_chain_id=None):
+        # Newest VerificationClose block per dest chain: of
+        # get_verification_close_blocks(), the only ones
+        # index_verification_close_block() would keep
+        self.ensure_index()
 
-    def get_verification_close_blocks(self, ignore_chain_id=None):
         close_blocks = []
-        for block in self.blocks:
-            if block.block_type == BlockType.VerificationClose:
-                if not ignore_chain_id or block.dest_chain_id != ignore_chain_id:
-                    close_blocks.append(block)
+        for (block_type, chain_id), positions in self.verification_index.items():
+            if block_type == BlockType.VerificationClose and chain_id != ignore_chain_id:
+                close_blocks.append(self.blocks[positions[-1]])
 
         return close_blocks
 
     def get_verification_subchain(self, verification_block, begin_idx, other_chain_id):
         sub_chain = []
 
+        # Only blocks involving other_chain_id can be in it
+        positions = self.get_peer_positions(other_chain_id)
+
         # Iterate from top to bottom
-        for idx in range(begin_idx, -1, -1):
-            block = self.blocks[idx]
+        for i in range(bisect_right(positions, begin_idx) - 1, -1, -1):
+            block = self.blocks[positions[i]]
             if self.block_in_verification(block, other_chain_id):
                 sub_chain.append(block)
 
@@ -1098,6 +1682,105 @@ class Chain():
 
         return sub_block
 
+    def get_merkle_roots(self):
+        if self.merkle_roots is None:
+            self.merkle_roots = self.loader.load_sidecar('merkle') or {}
+
+        return self.merkle_roots
+
+    def commit_merkle_root(self, block_hash, sub_chain):
+        # Kept in the 'merkle' sidecar, written with the next save
+        from merkle import merkle_root
+
+        self.get_merkle_roots()[block_hash] = {
+            'Root': merkle_root([block.block_hash for block in sub_chain]),
+            'Leaves': len(sub_chain),
+        }
+        self.merkle_roots_dirty = True
+
+    def get_verification_leaves(self, verification_block_hash):
+        # The sub-chain a Verification block on this chain covers, in the
+        # order hard_verify() hashed it: from the previous Verification
+        # block for the same chain (included) up to this one.
+        # (verification_block, [blocks]), or (None, None) if it isn't one.
+        idx = self.get_block_idx_by_hash(verification_block_hash)
+        if idx is None or self.blocks[idx].block_type != BlockType.Verification:
+            return None, None
+
+        verification_block = self.blocks[idx]
+        other_chain_id = verification_block.src_chain_id
+
+        _, begin_idx = self.get_verification_block(other_chain_id, idx - 1)
+
+        positions = self.get_peer_positions(other_chain_id)
+        sub_chain = []
+        for position in positions[bisect_left(positions, begin_idx or 0):bisect_left(positions, idx)]:
+            block = self.blocks[position]
+            if self.block_in_verification(block, other_chain_id):
+                sub_chain.append(block)
+
+        return verification_block, sub_chain
+
+    def get_verification_proof(self, verification_block_hash, block_hash):
+        # Merkle inclusion proof of block_hash in the sub-chain covered by a
+        # Verification block, checkable with merkle.verify_proof() against
+        # Root. CommittedRoot is the root hard_verify() recorded, if it did.
+        from merkle import merkle_root, merkle_proof
+
+        verification_block, sub_chain = self.get_verification_leaves(verification_block_hash)
+        if not verification_block:
+            return None
+
+        block_hashes = [block.block_hash for block in sub_chain]
+        if block_hash not in block_hashes:
+            return None
+
+        leaf_idx = block_hashes.index(block_hash)
+
+        from hashlib import sha256
+        sub_chain_hash = sha256()
+        for sub_block_hash in block_hashes:
+            sub_chain_hash.update(sub_block_hash.encode('utf-8'))
+
+        committed = self.get_merkle_roots().get(verification_block_hash)
+
+        return {
+            'VerificationBlockHash': verification_block_hash,
+            'BlockHash': block_hash,
+            'LeafIndex': leaf_idx,
+            'Leaves': len(block_hashes),
+            'Root': merkle_root(block_hashes),
+            'CommittedRoot': committed['Root'] if committed else None,
+            'SubChainHashValid': sub_chain_hash.hexdigest() == verification_block.sub_chain_hash,
+            'Proof': merkle_proof(block_hashes, leaf_idx),
+        }
+
+    def get_verification_close_proof(self, close_block_hash, block_hash, other_chain):
+        # get_verification_proof() for a VerificationClose block on this
+        # chain: the sub-chain it closes is on other_chain, under the
+        # Verification block it points to. CommittedRoot is the root this
+        # chain recorded for the VerificationClose block.
+        close_block = self.get_block_by_hash(close_block_hash)
+        if not close_block or close_block.block_type != BlockType.VerificationClose:
+            return None
+
+        if str(other_chain.uuid) != str(close_block.dest_chain_id):
+            return None
+
+        proof = other_chain.get_verification_proof(close_block.other_verification_block_hash, block_hash)
+        if not proof:
+            return None
+
+        verification_block = other_chain.get_block_by_hash(close_block.other_verification_block_hash)
+        committed = self.get_merkle_roots().get(close_block_hash)
+
+        return {
+            **proof,
+            'VerificationCloseBlockHash': close_block_hash,
+            'CommittedRoot': committed['Root'] if committed else None,
+            'SubChainHashValid': proof['SubChainHashValid'] and close_block.sub_chain_hash == verification_block.sub_chain_hash,
+        }
+
     def compute_validation_subchain(self, sub_chain):
         sub_chain_balance = Decimal('0')
             
@@ -1112,6 +1795,17 @@ class Chain():
 
         return sub_chain_balance, sub_chain_hash.hexdigest()
 
+    def get_summary(self):
+        head_block = self.head_block()
+
+        return {
+            'ID': self.uuid,
+            'BlockType': BlockTypeMap[head_block.block_type],
+            'HeadHash': head_block.block_hash,
+            'Balance': str(self.balance()),
+            'BlockHeight': head_block.height
+        }
+
     def get_stats(self):
         stats = {
             'Balance': str(self.balance()),
@@ -1129,36 +1823,47 @@ class Chain():
 
         if not existing_block or existing_block.height < verification_close_block.height:
             self.verification_close_block_index[chain_id] = verification_close_block
+            self.save()
 
-        self.save()
+    def get_credibility_ledger(self):
+        # Locked like add_block(), which applies new blocks to the same ledger
+        with lock_chains(self.uuid):
+            if self.credibility is None:
+                serialized = self.loader.load_sidecar('cred')
+                self.credibility = CredibilityLedger.deserialize(serialized) if serialized else CredibilityLedger()
+                self.credibility_saved = (self.credibility.height, self.credibility.head_hash)
+
+            self.credibility.catch_up(self.blocks, self.get_block_by_hash)
+
+            # Inside a batch it's written when the batch ends
+            if not self.batch_depth:
+                self.save_credibility()
+
+            return self.credibility
+
+    def save_credibility(self):
+        # The ledger is written when it's read or a batch ends rather than on
+        # every save(); a stale one on disk is caught up from the chain.
+        if self.credibility is None or not self.credibility.is_current(self.blocks):
+            return
+
+        saved = (self.credibility.height, self.credibility.head_hash)
+        if saved != self.credibility_saved:
+            with lock_chains(self.uuid):
+                self.loader.save_sidecar('cred', self.credibility.serialize())
+            self.credibility_saved = saved
 
     def get_credibility(self, other_chain_id=None, minimal=False):
+        if minimal:
+            return self.get_credibility_ledger().get_stats(other_chain_id)
+
+        # The per-block breakdown isn't kept in the ledger, so replay the chain
         chain = self
 
-        dest_block_types = (
-            BlockType.TargetRewardSent,
-            BlockType.SignalSent,
-            BlockType.SignalRewardSent,
-            BlockType.WorkOutputRewardSent,
-            BlockType.AccessContractOwn,
-        )
-        
-        src_block_types = (
-            BlockType.TargetRewardReceived,
-            BlockType.SignalRewardReceived,
-            BlockType.SignalReceived,
-            BlockType.WorkOutputRewardReceived,
-            BlockType.AccessContractOther,
-        )
+        dest_block_types = DEST_BLOCK_TYPES
+        src_block_types = SRC_BLOCK_TYPES
 
-        credit_stats = defaultdict(lambda: {
-            'Balance': Decimal('0'),
-            'Debit': Decimal('0'),
-            'Credit': Decimal('0'),
-            'TotalVerified': Decimal('0'),
-            'TotalOtherVerified': Decimal('0'),
-            'Blocks': []
-        })
+        credit_stats = defaultdict(empty_stats)
 
         for block in chain.blocks:
             
@@ -1269,9 +1974,15 @@ class Chain():
             print('No verification block found')
             return None
 
-    def hard_verify(self, other_chain):
+    def hard_verify(self, other_chain, merkle=None):
         chain = self
 
+        # merkle=True also commits a Merkle root of the sub-chain on both
+        # chains, see get_verification_proof(); by default DUO_MERKLE_COMMITMENTS
+        if merkle is None:
+            from config import config
+            merkle = str(config.get('DUO_MERKLE_COMMITMENTS', '')).lower() in ('1', 'true', 'yes')
+
         # Add a 'was verified by chain 2' block to chain 1
         # Add a 'verified chain 1' block to chain 2
 
@@ -1289,148 +2000,167 @@ class Chain():
         #     - hash-chain of the sub-chain being verified (including last verification block)
         #     - flag for whether a full verification was done?
 
-        # 1. Find the most recent verification block, if any.
-        #       This could be cached/indexed in the future
+        # 1. Find the most recent verification block, if any (see verification_index)
 
         # 2. Get key pieces of data
 
-        sub_chain = []
-        sub_chain_balance = Decimal('0')
+        # Both chains are saved once, at the end
+        with batch(chain, other_chain):
+            sub_chain = []
+            sub_chain_balance = Decimal('0')
         
-        from hashlib import sha256
-        sub_chain_hash = sha256()
-
-        prev_verification_block = None
-        # Iterate from top to bottom
-        for idx in range(len(chain.blocks) - 1, -1, -1):
-            block = chain.blocks[idx]
-            if block.block_type == BlockType.Verification:
-                if block.src_chain_id == other_chain.uuid:
-                    prev_verification_block = block
-                    break
-
-        chain_length = len(chain.blocks)
-        begin_idx = 0
-        prev_verification_block_hash = None
-        if prev_verification_block:
-            begin_idx = idx
-            prev_verification_block_hash = prev_verification_block.block_hash
-
-        # Iterate from bottom or latest verification block to top.
-        for idx in range(begin_idx, chain_length):
-            block = chain.blocks[idx]
-            new_block = chain.block_in_verification(block, other_chain.uuid)
-
-            if new_block:
-                sub_chain.append(block)
-                sub_chain_balance += block.balance_delta
-                sub_chain_hash.update(block.block_hash.encode('utf-8'))
-
-        sub_chain_length = len(sub_chain)
+            from hashlib import sha256
+            sub_chain_hash = sha256()
+
+            prev_verification_block, idx = chain.get_verification_block(other_chain.uuid)
+
+            chain_length = len(chain.blocks)
+            begin_idx = 0
+            prev_verification_block_hash = None
+            if prev_verification_block:
+                begin_idx = idx
+                prev_verification_block_hash = prev_verification_block.block_hash
+
+            # Iterate from bottom or latest verification block to top,
+            # over the blocks involving the other chain only
+            positions = chain.get_peer_positions(other_chain.uuid)
+            for idx in positions[bisect_left(positions, begin_idx):]:
+                block = chain.blocks[idx]
+                new_block = chain.block_in_verification(block, other_chain.uuid)
+
+                if new_block:
+                    sub_chain.append(block)
+                    sub_chain_balance += block.balance_delta
+                    sub_chain_hash.update(block.block_hash.encode('utf-8'))
+
+            sub_chain_length = len(sub_chain)
+
+            other_block_open = VerificationOpen()
+            other_block_open.update(
+                dest_chain_id=chain.uuid
+            )
+            other_chain.add_block(other_block_open)
+            other_chain.save()
 
-        other_block_open = VerificationOpen()
-        other_block_open.update(
-            dest_chain_id=chain.uuid
-        )
-        other_chain.add_block(other_block_open)
-        other_chain.save()
-
-        new_verification_block = None
-        other_block_close = None
-
-        if sub_chain_length > 1:
-            print(f'Previous verification block: {prev_verification_block}')
-            print(f'Current block height of chain 1: {chain_length}')
-            print(f'Current balance of chain 1: {chain.balance()}')
-            print(f'Number of chain 2 blocks in chain 1: {sub_chain_length}')
-            print(f'Total balance of all chain 2 blocks in chain 1: {sub_chain_balance}')
-            print(f'Hash-chain of the sub-chain being verified (including last verification block): {sub_chain_hash.hexdigest()}')
-            print(f'Flag for whether a full verification was done: True')
-
-            other_verification_block_hash = other_block_open.block_hash
-            full_verification = True
-
-            new_verification_block = Verification()
-            new_verification_block.update(
-                src_chain_id=other_chain.uuid,
-                prev_verification_block_hash=prev_verification_block_hash,
-                other_verification_block_hash=other_verification_block_hash,
+            new_verification_block = None
+            other_block_close = None
+
+            if sub_chain_length > 1:
+                print(f'Previous verification block: {prev_verification_block}')
+                print(f'Current block height of chain 1: {chain_length}')
+                print(f'Current balance of chain 1: {chain.balance()}')
+                print(f'Number of chain 2 blocks in chain 1: {sub_chain_length}')
+                print(f'Total balance of all chain 2 blocks in chain 1: {sub_chain_balance}')
+                print(f'Hash-chain of the sub-chain being verified (including last verification block): {sub_chain_hash.hexdigest()}')
+                print(f'Flag for whether a full verification was done: True')
+
+                other_verification_block_hash = other_block_open.block_hash
+                full_verification = True
+
+                new_verification_block = Verification()
+                new_verification_block.update(
+                    src_chain_id=other_chain.uuid,
+                    prev_verification_block_hash=prev_verification_block_hash,
+                    other_verification_block_hash=other_verification_block_hash,
                 
-                chain_length=chain_length,
+                    chain_length=chain_length,
 
-                sub_chain_balance=sub_chain_balance,
-                sub_chain_length=sub_chain_length,
-                sub_chain_hash=sub_chain_hash.hexdigest(),
+                    sub_chain_balance=sub_chain_balance,
+                    sub_chain_length=sub_chain_length,
+                    sub_chain_hash=sub_chain_hash.hexdigest(),
                 
-                full_verification=full_verification
-            )
-            chain.add_block(new_verification_block)
-            chain.save()
-
-            other_block_close = VerificationClose()
-            other_block_close.update(
-                dest_chain_id=chain.uuid,
-                open_verification_block_hash=other_block_open.block_hash,
-                other_verification_block_hash=new_verification_block.block_hash,
+                    full_verification=full_verification
+                )
+                chain.add_block(new_verification_block)
+                chain.save()
+
+                other_block_close = VerificationClose()
+                other_block_close.update(
+                    dest_chain_id=chain.uuid,
+                    open_verification_block_hash=other_block_open.block_hash,
+                    other_verification_block_hash=new_verification_block.block_hash,
                 
-                chain_length=chain_length,
+                    chain_length=chain_length,
 
-                sub_chain_balance=sub_chain_balance,
-                sub_chain_length=sub_chain_length,
-                sub_chain_hash=sub_chain_hash.hexdigest(),
+                    sub_chain_balance=sub_chain_balance,
+                    sub_chain_length=sub_chain_length,
+                    sub_chain_hash=sub_chain_hash.hexdigest(),
                 
-                full_verification=full_verification
-            )
-            other_chain.add_block(other_block_close)
-            other_chain.save()
+                    full_verification=full_verification
+                )
+                other_chain.add_block(other_block_close)
+                other_chain.save()
 
-        else:
-            print('Nothing to do.')
+                if merkle:
+                    chain.commit_merkle_root(new_verification_block.block_hash, sub_chain)
+                    other_chain.commit_merkle_root(other_block_close.block_hash, sub_chain)
+                    chain.save()
+                    other_chain.save()
 
-        # Trade VerificationClose blocks between the chains
+            else:
+                print('Nothing to do.')
 
-        # Pull from other chain
-        verification_close_blocks = other_chain.get_verification_close_blocks(ignore_chain_id=chain.uuid)
-        if len(verification_close_blocks):
-            print(f'Pulled {len(verification_close_blocks)} VerificationClose blocks from {other_chain.uuid}')
-        else:
-            print(f'Pulled no VerificationClose blocks from {other_chain.uuid}')
+            # Trade VerificationClose blocks between the chains
 
-        for verification_close_block in verification_close_blocks:
-            chain.index_verification_close_block(verification_close_block)
+            # Pull from other chain
+            verification_close_blocks = other_chain.get_latest_verification_close_blocks(ignore_chain_id=chain.uuid)
+            if len(verification_close_blocks):
+                print(f'Pulled {len(verification_close_blocks)} VerificationClose blocks from {other_chain.uuid}')
+            else:
+                print(f'Pulled no VerificationClose blocks from {other_chain.uuid}')
 
-        for verification_close_block in other_chain.verification_close_block_index.values():
-            chain.index_verification_close_block(verification_close_block)
+            for verification_close_block in verification_close_blocks:
+                chain.index_verification_close_block(verification_close_block)
 
-        print(len(chain.verification_close_block_index.keys()))
+            for verification_close_block in other_chain.verification_close_block_index.values():
+                chain.index_verification_close_block(verification_close_block)
 
-        # Push to other chain
-        verification_close_blocks = chain.get_verification_close_blocks(ignore_chain_id=other_chain.uuid)
-        if len(verification_close_blocks):
-            print(f'Pushed {len(verification_close_blocks)} VerificationClosed blocks to {chain.uuid}')
-        else:
-            print(f'Pushed no VerificationClose blocks to {chain.uuid}')
+            print(len(chain.verification_close_block_index.keys()))
 
-        for verification_close_block in verification_close_blocks:
-            other_chain.index_verification_close_block(verification_close_block)
+            # Push to other chain
+            verification_close_blocks = chain.get_latest_verification_close_blocks(ignore_chain_id=other_chain.uuid)
+            if len(verification_close_blocks):
+                print(f'Pushed {len(verification_close_blocks)} VerificationClosed blocks to {chain.uuid}')
+            else:
+                print(f'Pushed no VerificationClose blocks to {chain.uuid}')
+
+            for verification_close_block in verification_close_blocks:
+                other_chain.index_verification_close_block(verification_close_block)
+
+            for verification_close_block in chain.verification_close_block_index.values():
+                other_chain.index_verification_close_block(verification_close_block)
+
+            print(len(other_chain.verification_close_block_index.keys()))
+
+            return {
+                'verified': new_verification_block is not None,
+                'chain': {
+                    'uuid': chain.uuid,
+                    'verification_block': new_verification_block
+                },
+                'other_chain': {
+                    'uuid': other_chain.uuid,
+                    'open_block': other_block_open,
+                    'close_block': other_block_close,
+                }
+            }
 
-        for verification_close_block in chain.verification_close_block_index.values():
-            other_chain.index_verification_close_block(verification_close_block)
 
-        print(len(other_chain.verification_close_block_index.keys()))
+def get_chain_file(chain_path: str, chain_uuid: str):
+    import os
 
-        return {
-            'verified': new_verification_block is not None,
-            'chain': {
-                'uuid': chain.uuid,
-                'verification_block': new_verification_block
-            },
-            'other_chain': {
-                'uuid': other_chain.uuid,
-                'open_block': other_block_open,
-                'close_block': other_block_close,
-            }
-        }
+    # A chain keeps whichever storage it was created with
+    for ext in ('jsonl', 'json'):
+        chain_file = f'{chain_path}/chain_{chain_uuid}.{ext}'
+        if os.path.exists(chain_file):
+            return chain_file
+
+
+def get_loader(chain_file: str):
+    if chain_file.endswith('.jsonl'):
+        return LogLoader(chain_file)
+
+    return JSONLoader(chain_file)
 
 
 def init_chain(chain_uuid=None):
@@ -1444,56 +2174,263 @@ def init_chain(chain_uuid=None):
     from config import config
 
     chain_path = config['DUO_CHAIN_PATH']
-    chain_file = f'{chain_path}/chain_{chain_uuid}.json'
+    seed = f'seed-{chain_uuid}'
 
-    if os.path.exists(chain_file):
+    if get_chain_file(chain_path, chain_uuid):
         raise Exception('Chain already exists')
 
-    with open(chain_file, 'w') as f:
-        f.write(json.dumps({
-            'uuid': str(chain_uuid),
-            'seed': f'seed-{chain_uuid}',
-            'blocks': []
-        }, indent=2))
+    # 'json' rewrites the whole chain file on every save, 'log' appends new blocks only
+    storage = config.get('DUO_CHAIN_STORAGE', 'json')
+
+    if storage == 'log':
+        loader = LogLoader.create(f'{chain_path}/chain_{chain_uuid}.jsonl', chain_uuid, seed)
+    elif storage == 'json':
+        chain_file = f'{chain_path}/chain_{chain_uuid}.json'
+        with open(chain_file, 'w') as f:
+            f.write(json.dumps({
+                'uuid': str(chain_uuid),
+                'seed': seed,
+                'blocks': []
+            }, indent=2))
+
+        loader = JSONLoader(chain_file)
+    else:
+        raise Exception(f'Unknown chain storage: {storage}')
 
     interface = None
-    chain = Chain(interface, JSONLoader(chain_file))
+    chain = Chain(interface, loader)
+    chain.get_manifest().update(chain.get_summary())
 
     return chain
 
 
-chain_cache = {}
+class ChainCache():
+    # LRU of loaded chains, bounded by entry count and by the total size of
+    # the chain files behind them. An entry is only served while its chain
+    # file is unchanged on disk; saves made through the cached Chain itself
+    # (tracked by Chain.write_version) refresh the entry instead of evicting it.
+
+    def __init__(self, max_entries, max_bytes):
+        import threading
+        from collections import OrderedDict
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, chain_uuid, chain_file):
+        stat = file_stat(chain_file)
+
+        with self.lock:
+            entry = self.entries.get(chain_uuid)
+            if not entry:
+                return None
+
+            chain = entry['chain']
+            if entry['write_version'] != chain.write_version:
+                # Saved in-process since we last looked, so the file on disk is this chain
+                self.resize(entry, stat)
+                entry['write_version'] = chain.write_version
+
+            if entry['chain_file'] != chain_file or entry['stat'] != stat:
+                # Changed by someone else
+                self.remove(chain_uuid)
+                return None
+
+            self.entries.move_to_end(chain_uuid)
+
+            return chain
+
+    def put(self, chain_uuid, chain_file, chain, stat):
+        with self.lock:
+            self.remove(chain_uuid)
+
+            entry = {
+                'chain': chain,
+                'chain_file': chain_file,
+                'stat': None,
+                'size': 0,
+                'write_version': chain.write_version,
+            }
+            self.entries[chain_uuid] = entry
+            self.resize(entry, stat)
+
+            # Never evict the entry we just added, even if it is over budget alone
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+
+    def discard(self, chain_uuid):
+        # Drop a chain whose in-memory state may no longer match its file
+        with self.lock:
+            self.remove(chain_uuid)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def remove(self, chain_uuid):
+        entry = self.entries.pop(chain_uuid, None)
+        if entry:
+            self.total_bytes -= entry['size']
+
+    def resize(self, entry, stat):
+        entry['stat'] = stat
+        self.total_bytes += stat[1] - entry['size']
+        entry['size'] = stat[1]
+
+
+class ChainLocks():
+    # One re-entrant lock per chain uuid. Whatever reads a chain, changes it
+    # and saves it holds that chain's lock throughout, so writers to the same
+    # chain take turns while writers to different chains don't wait on each other.
+
+    def __init__(self):
+        import threading
 
-def get_chain(chain_uuid: str, cache_ttl=None):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, chain_uuid):
+        import threading
+
+        with self.lock:
+            lock = self.locks.get(chain_uuid)
+            if not lock:
+                lock = self.locks[chain_uuid] = threading.RLock()
+
+            return lock
+
+    def hold(self, *chain_uuids):
+        from contextlib import ExitStack
+
+        stack = ExitStack()
+
+        # Always in the same order, so two multi-chain writers can't deadlock
+        for chain_uuid in sorted(set(str(chain_uuid) for chain_uuid in chain_uuids)):
+            stack.enter_context(self.get(chain_uuid))
+
+        return stack
+
+
+chain_locks = ChainLocks()
+
+def lock_chains(*chain_uuids):
+    return chain_locks.hold(*chain_uuids)
+
+
+@contextmanager
+def batch(*chains):
+    # Chain.batch() over several chains at once: each is saved once on exit,
+    # and none of them are saved if the batch raises. See flush_batches() for
+    # how the saves go out.
+    from contextlib import ExitStack
+
+    with lock_chains(*[chain.uuid for chain in chains]), ExitStack() as stack:
+        for chain in chains:
+            stack.enter_context(chain.batch())
+
+        yield chains
+
+        # Chains inside an outer batch of their own are saved when that ends
+        flush_batches(*[chain for chain in chains if chain.batch_depth == 1 and chain.save_pending])
+
+
+def flush_batches(*chains):
+    # The saves batch() deferred for the chains, in two passes: every chain
+    # is written aside first (temp files, serialized log appends), then
+    # they're all swapped in and appended. A failure while writing aside
+    # leaves every chain as it was on disk. A crash part way through the
+    # second pass can still leave some chains saved and others not.
+    chains = list({id(chain): chain for chain in chains}.values())
+
+    with lock_chains(*[chain.uuid for chain in chains]):
+        pending = []
+        try:
+            for chain in chains:
+                pending.append((chain, chain.loader.prepare(chain.uuid, chain.seed, chain.blocks, full=chain.save_pending_full)))
+
+            while pending:
+                chain, chain_pending = pending[0]
+                chain.commit_save(chain.loader, chain_pending)
+                chain.save_pending = False
+                pending.pop(0)
+        except BaseException:
+            for chain, chain_pending in pending:
+                chain.loader.abort(chain_pending)
+            raise
+
+
+def file_stat(path):
     import os
-    import json
-    import time
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None, 0
+
+    return st.st_mtime_ns, st.st_size
+
+
+def init_chain_cache():
+    from config import config
+
+    return ChainCache(
+        int(config.get('DUO_CHAIN_CACHE_MAX_ENTRIES', 128)),
+        int(config.get('DUO_CHAIN_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    )
+
 
-    if cache_ttl:
-        cached_chain = chain_cache.get(chain_uuid)
-        if cached_chain:
-            if time.time() - cached_chain['ts'] < cache_ttl:
-                return cached_chain['chain']
+chain_cache = init_chain_cache()
 
+def get_chain(chain_uuid: str, cache=True):
+    # cache=False for a pass over many chains: a chain already cached is
+    # still used, but one loaded here isn't added, so the pass doesn't
+    # evict the working set
     from config import config
 
     chain_path = config['DUO_CHAIN_PATH']
-    chain_file = f'{chain_path}/chain_{chain_uuid}.json'
+    chain_file = get_chain_file(chain_path, chain_uuid)
+
+    if not chain_file:
+        chain_cache.discard(chain_uuid)
+        raise Exception(f'Chain not found: {chain_path}/chain_{chain_uuid}.json')
+
+    chain = chain_cache.get(chain_uuid, chain_file)
+    if chain:
+        return chain
 
-    if not os.path.exists(chain_file):
-        raise Exception(f'Chain not found: {chain_file}')
+    # Stat before loading: a write racing with the load then shows up as a change next time
+    stat = file_stat(chain_file)
 
     interface = None
-    chain = Chain(interface, JSONLoader(chain_file))
+    chain = Chain(interface, get_loader(chain_file))
 
-    chain_cache[chain_uuid] = {
-        'ts': time.time(),
-        'chain': chain
-    }
+    if cache:
+        chain_cache.put(chain_uuid, chain_file, chain, stat)
 
     return chain
 
 
+def get_chain_files(chain_path: str):
+    import os
+    import glob
+
+    chain_files = {}
+    for ext in ('json', 'jsonl'):
+        search = os.path.join(chain_path, f'chain*.{ext}')
+        for chain_file in glob.glob(search):
+            if is_sidecar(chain_file):
+                continue
+
+            # Same uuid in both storages: the log wins, as in get_chain_file()
+            chain_files[os.path.splitext(chain_file)[0]] = chain_file
+
+    return list(chain_files.values())
+
+
 def get_chains(chain_path: str = './chains'):
     import os
     import json
@@ -1504,14 +2441,9 @@ def get_chains(chain_path: str = './chains'):
     chains = []
     interface = None
 
-    import glob
-    search = os.path.join(chain_path, 'chain*.json')
-    for chain_file in glob.glob(search):
-        if '_vcbidx' in chain_file:
-            continue
-
+    for chain_file in get_chain_files(chain_path):
         try:
-            chains.append(Chain(interface, JSONLoader(chain_file)))
+            chains.append(Chain(interface, get_loader(chain_file)))
         except Exception as e:
             print(f'Error loading chain file : {e}')
         else:
@@ -0,0 +1,137 @@
+from decimal import Decimal
+from collections import defaultdict
+
+from blocks import BlockType
+
+
+# Debits referencing these count against the block's dest_chain_id
+DEST_BLOCK_TYPES = (
+    BlockType.TargetRewardSent,
+    BlockType.SignalSent,
+    BlockType.SignalRewardSent,
+    BlockType.WorkOutputRewardSent,
+    BlockType.AccessContractOwn,
+)
+
+# Accepted credits referencing these count towards the block's src_chain_id
+SRC_BLOCK_TYPES = (
+    BlockType.TargetRewardReceived,
+    BlockType.SignalRewardReceived,
+    BlockType.SignalReceived,
+    BlockType.WorkOutputRewardReceived,
+    BlockType.AccessContractOther,
+)
+
+STAT_KEYS = ('Debit', 'Credit', 'TotalVerified', 'TotalOtherVerified')
+
+
+def empty_stats():
+    return {
+        'Balance': Decimal('0'),
+        'Debit': Decimal('0'),
+        'Credit': Decimal('0'),
+        'TotalVerified': Decimal('0'),
+        'TotalOtherVerified': Decimal('0'),
+        'Blocks': []
+    }
+
+
+class CredibilityLedger():
+    # Running per-counterparty totals for Chain.get_credibility(minimal=True).
+    # Blocks are applied in chain order; height/head_hash record how far the
+    # ledger got, so a persisted ledger can be caught up instead of replayed.
+
+    def __init__(self):
+        self.totals = {}
+        self.height = 0
+        self.head_hash = None
+
+    def apply(self, block, get_block_by_hash):
+        block_type = block.block_type
+
+        if block_type == BlockType.Debit:
+            ref_block = self.get_ref_block(block, get_block_by_hash)
+            if ref_block and ref_block.block_type in DEST_BLOCK_TYPES:
+                self.add(ref_block.dest_chain_id, 'Debit', block.balance_delta)
+
+        elif block_type == BlockType.CreditAccepted:
+            ref_block = self.get_ref_block(block, get_block_by_hash)
+            if ref_block and ref_block.block_type in SRC_BLOCK_TYPES:
+                self.add(ref_block.src_chain_id, 'Credit', block.balance_delta)
+
+        elif block_type == BlockType.SignalRewardSent:
+            # Special case because this is how currency is mined
+            self.add(block.dest_chain_id, 'Credit', block.amount)
+
+        elif block_type == BlockType.Verification:
+            self.add(block.src_chain_id, 'TotalVerified', block.sub_chain_balance)
+
+        elif block_type == BlockType.VerificationClose:
+            self.add(block.dest_chain_id, 'TotalOtherVerified', block.sub_chain_balance)
+
+        self.height += 1
+        self.head_hash = block.block_hash
+
+    def get_ref_block(self, block, get_block_by_hash):
+        if not block.ref_block_hash:
+            return None
+
+        return get_block_by_hash(block.ref_block_hash)
+
+    def add(self, chain_id, key, amount):
+        totals = self.totals.get(chain_id)
+        if totals is None:
+            totals = self.totals[chain_id] = dict.fromkeys(STAT_KEYS, Decimal('0'))
+
+        totals[key] += amount
+
+    def is_current(self, blocks):
+        if self.height == 0:
+            return not blocks
+
+        return self.height == len(blocks) and blocks[-1].block_hash == self.head_hash
+
+    def catch_up(self, blocks, get_block_by_hash):
+        # Start over if the blocks the ledger was built from are gone or changed
+        if self.height > len(blocks) or (self.height and blocks[self.height - 1].block_hash != self.head_hash):
+            self.__init__()
+
+        for block in blocks[self.height:]:
+            self.apply(block, get_block_by_hash)
+
+    def get_stats(self, other_chain_id=None):
+        stats = defaultdict(empty_stats)
+
+        if other_chain_id:
+            chain_ids = [other_chain_id] if other_chain_id in self.totals else []
+        else:
+            chain_ids = self.totals.keys()
+
+        for chain_id in chain_ids:
+            entry = stats[chain_id]
+            entry.update(self.totals[chain_id])
+            entry['Balance'] = entry['Debit'] + entry['Credit']
+
+        return stats
+
+    def serialize(self):
+        return {
+            'height': self.height,
+            'head_hash': self.head_hash,
+            'totals': {
+                chain_id: {key: str(val) for key, val in totals.items()}
+                for chain_id, totals in self.totals.items()
+            }
+        }
+
+    @staticmethod
+    def deserialize(serialized):
+        ledger = CredibilityLedger()
+        ledger.height = int(serialized['height'])
+        ledger.head_hash = serialized['head_hash']
+        ledger.totals = {
+            chain_id: {key: Decimal(val) for key, val in totals.items()}
+            for chain_id, totals in serialized['totals'].items()
+        }
+
+        return ledger
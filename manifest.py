@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+
+from blocks import BlockTypeMap
+
+
+# Not matched by the chain*.json[l] globs
+MANIFEST_FILE = 'manifest.jsonl'
+
+
+class ChainManifest():
+    # Head summary (ID, BlockType, HeadHash, Balance, BlockHeight) of every
+    # chain in a directory, so /state doesn't have to load any chain.
+    #
+    # Stored as an append-only log: every save appends the chain's new
+    # summary and deletions append a tombstone, the last line for an ID
+    # wins. Other processes' appends are picked up by reading on from where
+    # we last stopped. The log is compacted once it is mostly stale lines.
+    #
+    # Appends hold a shared lock on manifest.jsonl.lock and rewrites an
+    # exclusive one, so no process's append lands in a file being replaced.
+
+    def __init__(self, chain_path):
+        self.chain_path = chain_path
+        self.manifest_path = os.path.join(chain_path, MANIFEST_FILE)
+
+        self.entries = {}
+        self.num_lines = 0
+        self.offset = 0
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def get_entries(self):
+        with self.lock:
+            if not self.exists():
+                self.rebuild()
+            else:
+                self.refresh()
+
+            return list(self.entries.values())
+
+    def update(self, summary):
+        self.append({**summary})
+
+    def remove(self, chain_uuid):
+        self.append({'ID': chain_uuid, 'Deleted': True})
+
+    def append(self, record):
+        with self.lock:
+            if not self.exists():
+                # Appending to nothing would hide every other chain; the
+                # rebuild reads the chain files, which already reflect this record.
+                self.rebuild()
+                return
+
+            with self.file_lock(exclusive=False):
+                self.refresh()
+
+                with open(self.manifest_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+                self.refresh()
+
+            # Not under the shared lock, compact() waits for every holder of it
+            if self.num_lines > max(1000, 4 * len(self.entries)):
+                self.compact()
+
+    def refresh(self):
+        # Read whatever was appended since last time; start over if the file was replaced.
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            self.reset()
+            return
+
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.reset()
+            self.inode = st.st_ino
+
+        if st.st_size == self.offset:
+            return
+
+        with open(self.manifest_path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Another writer is mid-append, pick it up next time
+                    break
+
+                self.offset += len(line)
+                self.num_lines += 1
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f'Skipping bad manifest line in {self.manifest_path}')
+                    continue
+
+                self.apply(record)
+
+    def apply(self, record):
+        if record.get('Deleted'):
+            self.entries.pop(record['ID'], None)
+        else:
+            self.entries[record['ID']] = record
+
+    def reset(self):
+        self.entries = {}
+        self.num_lines = 0
+        self.offset = 0
+        self.inode = None
+
+    def compact(self):
+        with self.file_lock(exclusive=True):
+            # Lines other processes appended since our last read
+            self.refresh()
+            self.write(self.entries.values())
+
+    def rebuild(self):
+        # Re-derive every entry from the chain files, reading only their head block
+        from chain import get_chain_files
+
+        with self.file_lock(exclusive=True):
+            summaries = []
+            for chain_file in get_chain_files(self.chain_path):
+                try:
+                    summaries.append(read_chain_summary(chain_file))
+                except Exception as e:
+                    print(f'Error reading chain file {chain_file}: {e}')
+
+            self.write(summaries)
+
+        return summaries
+
+    @contextmanager
+    def file_lock(self, exclusive):
+        try:
+            import fcntl
+        except ImportError:
+            # No flock (Windows): only this process' threads are kept apart
+            yield
+            return
+
+        with open(f'{self.manifest_path}.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def write(self, summaries):
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            for summary in summaries:
+                f.write(json.dumps(summary) + '\n')
+
+        os.replace(tmp_path, self.manifest_path)
+
+        self.reset()
+        self.refresh()
+
+
+def read_chain_summary(chain_file):
+    # Chain.get_summary() for a chain on disk, without deserializing its blocks
+    if chain_file.endswith('.jsonl'):
+        with open(chain_file, 'rb') as f:
+            lines = [line for line in f.readlines() if line.endswith(b'\n')]
+
+        chain_uuid = json.loads(lines[0])['uuid']
+        head_block = json.loads(lines[-1]) if len(lines) > 1 else None
+    else:
+        with open(chain_file, 'r') as f:
+            chain = json.loads(f.read())
+
+        chain_uuid = chain['uuid']
+        head_block = chain['blocks'][-1] if chain['blocks'] else None
+
+    if not head_block:
+        # Same as an empty chain's NullBlock head
+        return {
+            'ID': chain_uuid,
+            'BlockType': BlockTypeMap[0],
+            'HeadHash': None,
+            'Balance': '0.0',
+            'BlockHeight': 0,
+        }
+
+    return {
+        'ID': chain_uuid,
+        'BlockType': BlockTypeMap[head_block['block_type']],
+        'HeadHash': head_block['block_hash'],
+        'Balance': head_block['balance'],
+        'BlockHeight': int(head_block['height']),
+    }
+
+
+manifests = {}
+manifests_lock = threading.Lock()
+
+def get_manifest(chain_path):
+    chain_path = os.path.normpath(chain_path)
+
+    with manifests_lock:
+        manifest = manifests.get(chain_path)
+        if not manifest:
+            manifest = manifests[chain_path] = ChainManifest(chain_path)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+    from config import config
+
+    parser = argparse.ArgumentParser(description='Maintain the chain head manifest used by /state')
+    parser.add_argument('command', choices=['rebuild', 'show'])
+    parser.add_argument('--path', default=config.get('DUO_CHAIN_PATH'), help='chain directory (default: DUO_CHAIN_PATH)')
+    args = parser.parse_args()
+
+    manifest = get_manifest(args.path)
+
+    if args.command == 'rebuild':
+        summaries = manifest.rebuild()
+        print(f'Rebuilt {manifest.manifest_path} with {len(summaries)} chains')
+    else:
+        for entry in manifest.get_entries():
+            print(json.dumps(entry))
@@ -0,0 +1,68 @@
+from hashlib import sha256
+
+
+# Merkle trees over a verification sub-chain's block hashes, see
+# Chain.get_verification_proof(). Leaves and inner nodes are hashed with
+# different prefixes, so an inner node can't be passed off as a leaf. An odd
+# node at the end of a level is carried up unchanged.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(block_hash):
+    return sha256(LEAF_PREFIX + block_hash.encode('utf-8')).hexdigest()
+
+
+def node_hash(left, right):
+    return sha256(NODE_PREFIX + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def build_levels(block_hashes):
+    # Every level of the tree, leaves first, root last
+    level = [leaf_hash(block_hash) for block_hash in block_hashes]
+    levels = [level]
+
+    while len(level) > 1:
+        next_level = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+
+        levels.append(next_level)
+        level = next_level
+
+    return levels
+
+
+def merkle_root(block_hashes):
+    if not block_hashes:
+        return None
+
+    return build_levels(block_hashes)[-1][0]
+
+
+def merkle_proof(block_hashes, idx):
+    # The sibling hashes from the leaf at idx up to the root, each with the
+    # side it goes on
+    proof = []
+    for level in build_levels(block_hashes)[:-1]:
+        sibling_idx = idx ^ 1
+        if sibling_idx < len(level):
+            proof.append({
+                'Hash': level[sibling_idx],
+                'Side': 'left' if sibling_idx < idx else 'right',
+            })
+
+        idx //= 2
+
+    return proof
+
+
+def verify_proof(block_hash, proof, root):
+    current = leaf_hash(block_hash)
+    for step in proof:
+        if step['Side'] == 'left':
+            current = node_hash(step['Hash'], current)
+        else:
+            current = node_hash(current, step['Hash'])
+
+    return current == root
@@ -0,0 +1,281 @@
+from decimal import Decimal
+from bisect import bisect_left, bisect_right
+from operator import eq, ne, lt, le, gt, ge
+
+
+VALUE_TYPES = {
+    'str': str,
+    'int': int,
+    'decimal': Decimal,
+    'dict': dict,
+}
+
+OPS = {
+    'eq': eq,
+    'ne': ne,
+    'lt': lt,
+    'lte': le,
+    'gt': gt,
+    'gte': ge,
+    'in': lambda current, value: current in value,
+    'range': lambda current, value: value[0] <= current <= value[1],
+}
+
+# Fields with their own index on Chain, see BlockQuery.get_candidates()
+PEER_FIELDS = ('src_chain_id', 'dest_chain_id')
+TS_OPS = ('eq', 'lt', 'lte', 'gt', 'gte', 'range')
+
+MISSING = object()
+
+
+def compile_path(path):
+    # 'signal_data.a.b' -> function returning block.signal_data['a']['b'],
+    # or MISSING if any step isn't there
+    attr, *keys = path.split('.')
+
+    def get(block):
+        current = getattr(block, attr, MISSING)
+        for key in keys:
+            current = get_item(current, key)
+            if current is MISSING:
+                break
+
+        return current
+
+    return get
+
+
+def get_item(container, key):
+    if type(container) is dict:
+        return container.get(key, MISSING)
+
+    if type(container) is list and key.lstrip('-').isdigit():
+        try:
+            return container[int(key)]
+        except IndexError:
+            return MISSING
+
+    return MISSING
+
+
+def compile_predicate(predicate):
+    # {'key': 'signal_data.a', 'op': 'eq', 'value': ..., 'value_type': 'str'}
+    key = predicate['key']
+    op = predicate.get('op') or 'eq'
+    value = predicate['value']
+    value_type = predicate.get('value_type')
+
+    if op not in OPS:
+        raise ValueError(f'Unknown query op: {op}')
+
+    if op in ('in', 'range') and type(value) not in (list, tuple):
+        raise ValueError(f'Query op {op} needs a list value for {key}')
+
+    if op == 'range' and len(value) != 2:
+        raise ValueError(f'Query op range needs [low, high] for {key}')
+
+    expected_type = None
+    if value_type:
+        if value_type not in VALUE_TYPES:
+            raise ValueError(f'Unknown value_type: {value_type}')
+
+        expected_type = VALUE_TYPES[value_type]
+        if op in ('in', 'range'):
+            value = [expected_type(val) for val in value]
+        else:
+            value = expected_type(value)
+
+    get = compile_path(key)
+    compare = OPS[op]
+
+    def match(block):
+        current = get(block)
+        if current is MISSING:
+            return False
+
+        # With a value_type the stored value must already be of that type
+        if expected_type and type(current) is not expected_type:
+            return False
+
+        try:
+            return compare(current, value)
+        except TypeError:
+            return False
+
+    return match
+
+
+def compile_attr_query(attr_query):
+    # The single attr_query block_query has always taken: subkey is only
+    # looked into for dict_props, and the value must be exactly of value_type.
+    query_key = attr_query['key']
+    query_subkey = attr_query.get('subkey')
+    query_value = attr_query['value']
+    expected_type = VALUE_TYPES[attr_query['value_type']]
+
+    subkeys = query_subkey.split('.') if query_subkey else []
+
+    def match(block):
+        current_value = getattr(block, query_key, MISSING)
+        if current_value is MISSING:
+            return False
+
+        if subkeys and query_key in block.dict_props:
+            value = current_value
+            for key in subkeys:
+                value = get_item(value, key)
+                if value is MISSING:
+                    break
+            else:
+                current_value = value
+
+        if type(current_value) != expected_type:
+            return False
+
+        return current_value == query_value
+
+    return match
+
+
+class BlockQuery():
+    # A block_query request compiled once into a matcher, run over the
+    # smallest candidate set the chain's indexes can give it.
+    #
+    # Results are in chain order, or newest first. cursor is the position a
+    # previous page stopped at, see run().
+
+    def __init__(self, block_type=None, predicates=None, attr_query=None, window_far=None, window_near=None):
+        if block_type is None:
+            self.block_types = None
+        elif type(block_type) in (list, tuple, set):
+            self.block_types = set(block_type)
+        else:
+            self.block_types = {block_type}
+
+        self.predicates = [dict(predicate) for predicate in predicates or []]
+
+        if window_far:
+            self.predicates.append({'key': 'ts', 'op': 'gte', 'value': window_far})
+        if window_near:
+            self.predicates.append({'key': 'ts', 'op': 'lte', 'value': window_near})
+
+        matchers = [compile_predicate(predicate) for predicate in self.predicates]
+        if attr_query:
+            matchers.append(compile_attr_query(attr_query))
+
+        self.matchers = matchers
+
+    def match(self, block):
+        if self.block_types is not None and block.block_type not in self.block_types:
+            return False
+
+        for matcher in self.matchers:
+            if not matcher(block):
+                return False
+
+        return True
+
+    def run(self, chain, limit=None, offset=0, cursor=None, newest_first=False):
+        # Returns (blocks, next_cursor). next_cursor is set whenever a full
+        # page of limit blocks comes back, without looking for a next match,
+        # so the page after a full last one is empty.
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be at least 1')
+
+        positions = self.get_candidates(chain)
+
+        if cursor is not None:
+            cursor = int(cursor)
+            if newest_first:
+                positions = positions[:bisect_left(positions, cursor)]
+            else:
+                positions = positions[bisect_right(positions, cursor):]
+
+        if newest_first:
+            positions = reversed(positions)
+
+        blocks = []
+        to_skip = offset or 0
+        next_cursor = None
+
+        for idx in positions:
+            block = chain.blocks[idx]
+            if not self.match(block):
+                continue
+
+            if to_skip:
+                to_skip -= 1
+                continue
+
+            blocks.append(block)
+
+            if limit is not None and len(blocks) == limit:
+                next_cursor = str(idx)
+                break
+
+        return blocks, next_cursor
+
+    def get_candidates(self, chain):
+        # Ascending positions of every block that could match, taken from
+        # whichever index gives the fewest
+        candidates = []
+
+        if self.block_types is not None:
+            candidates.append(chain.get_block_positions(list(self.block_types)))
+
+        ts_low = ts_high = None
+        for predicate in self.predicates:
+            key, op, value = predicate['key'], predicate.get('op') or 'eq', predicate['value']
+
+            if key == 'ts' and op in TS_OPS and not predicate.get('value_type'):
+                low, high = ts_bounds(op, value)
+                if low is not None:
+                    ts_low = low if ts_low is None else max(ts_low, low)
+                if high is not None:
+                    ts_high = high if ts_high is None else min(ts_high, high)
+
+            # The indexes below never hold empty values, so those are scanned for
+            if op != 'eq' or type(value) is not str or not value:
+                continue
+
+            if key == 'block_hash':
+                idx = chain.get_block_idx_by_hash(value)
+                candidates.append([idx] if idx is not None else [])
+
+            elif key == 'activity_id':
+                candidates.append(sorted(chain.get_activity_positions(value)))
+
+            elif key in PEER_FIELDS:
+                candidates.append(chain.get_peer_positions(value))
+
+            elif key.endswith('_block_hash') and key != 'prev_block_hash':
+                candidates.append(chain.get_referencing_positions(value, key))
+
+        if ts_low is not None or ts_high is not None:
+            block_types = self.block_types if self.block_types is not None else chain.get_indexed_block_types()
+            candidates.append(sorted(chain.get_block_positions_in_window(list(block_types), ts_low, ts_high)))
+
+        if not candidates:
+            return range(len(chain.blocks))
+
+        return min(candidates, key=len)
+
+
+def ts_bounds(op, value):
+    # Inclusive (low, high) of a ts predicate, or (None, None) if it can't
+    # narrow the ts index (ts is always an int)
+    if op == 'range':
+        if type(value[0]) is int and type(value[1]) is int:
+            return value[0], value[1]
+        return None, None
+
+    if type(value) is not int:
+        return None, None
+
+    return {
+        'eq': (value, value),
+        'lt': (None, value - 1),
+        'lte': (None, value),
+        'gt': (value + 1, None),
+        'gte': (value, None),
+    }[op]
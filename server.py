@@ -4,7 +4,7 @@ from decimal import Decimal
 import time
 
 from fastapi import FastAPI, Request, Response, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder, ENCODERS_BY_TYPE
 from fastapi import Header
 from pydantic import BaseModel, Json
@@ -15,7 +15,10 @@ ENCODERS_BY_TYPE[Decimal] = str
 
 from util import emit_state_change
 from config import config
-from chain import get_chain, get_chains, init_chain
+from functools import wraps
+
+from chain import get_chain, init_chain, chain_cache, lock_chains
+from manifest import get_manifest
 from blocks import BlockTypeMap, BlockType
 
 service_name = config['service_name']
@@ -23,6 +26,28 @@ service_name = config['service_name']
 app = FastAPI()
 
 
+def chain_writer(*uuid_params):
+    # Serialize an endpoint that changes chains with every other writer of
+    # the same chains; the chain uuids are taken from the named path params.
+    # If the endpoint raises, the cached chains may hold blocks that never
+    # made it to disk, so they're dropped and reloaded on next use.
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            chain_uuids = [str(kwargs[param]) for param in uuid_params]
+            with lock_chains(*chain_uuids):
+                try:
+                    return func(*args, **kwargs)
+                except BaseException:
+                    for chain_uuid in chain_uuids:
+                        chain_cache.discard(chain_uuid)
+                    raise
+
+        return wrapper
+
+    return decorator
+
+
 @app.on_event('startup')
 async def startup_event():
     current_state = get_current_state()
@@ -47,6 +72,56 @@ def chain_get_block_by_hash_GET(chain_uuid: UUID, block_hash: str):
     }
 
 
+@app.get('/chain/{chain_uuid}/block/{block_hash}/refs')
+def chain_block_refs_GET(chain_uuid: UUID, block_hash: str, depth: int = 1):
+    # What the block references, and what references it. depth > 1 follows
+    # the back-references further, e.g. target -> claim -> reward.
+    chain = get_chain(str(chain_uuid))
+    block = chain.get_block_by_hash(block_hash)
+
+    if not block:
+        return {
+            'found': False
+        }
+
+    refs = []
+    for field, ref_block_hash, ref_block in chain.get_refs(block):
+        refs.append({
+            'Field': field,
+            'BlockHash': ref_block_hash,
+            'BlockType': BlockTypeMap[ref_block.block_type] if ref_block else None,
+            'OnChain': ref_block is not None,
+        })
+
+    referenced_by = []
+    seen = {block_hash}
+    to_visit = [block_hash]
+    for level in range(1, max(1, min(depth, 10)) + 1):
+        next_visit = []
+        for ref_block_hash in to_visit:
+            for field, ref_block in chain.get_referencing_blocks(ref_block_hash):
+                referenced_by.append({
+                    'Field': field,
+                    'BlockHash': ref_block.block_hash,
+                    'BlockType': BlockTypeMap[ref_block.block_type],
+                    'RefBlockHash': ref_block_hash,
+                    'Depth': level,
+                })
+
+                if ref_block.block_hash not in seen:
+                    seen.add(ref_block.block_hash)
+                    next_visit.append(ref_block.block_hash)
+
+        to_visit = next_visit
+
+    return {
+        'BlockHash': block.block_hash,
+        'BlockType': BlockTypeMap[block.block_type],
+        'Refs': refs,
+        'ReferencedBy': referenced_by,
+    }
+
+
 class AttrQuery(BaseModel):
     key: str
     subkey: Optional[str] = None
@@ -54,30 +129,69 @@ class AttrQuery(BaseModel):
     value_type: str
 
 
+class Predicate(BaseModel):
+    key: str
+    op: Optional[str] = 'eq'
+    value: Any
+    value_type: Optional[str] = None
+
+
 class BlockQuery(BaseModel):
-    block_type: Union[int, list]
+    block_type: Optional[Union[int, list]] = None
     attr_query: Optional[AttrQuery] = None
+    predicates: Optional[list[Predicate]] = None
     multiple: Optional[bool] = None
     window_far: Optional[int] = None
     window_near: Optional[int] = None
 
+    # Paging: given limit or cursor, the response is {'Blocks': [...], 'NextCursor': ...}
+    limit: Optional[int] = None
+    offset: Optional[int] = None
+    cursor: Optional[str] = None
+    newest_first: Optional[bool] = None
+
+    # Only return these keys of each serialized block
+    fields: Optional[list[str]] = None
+
 
 @app.post('/chain/{chain_uuid}/block/query')
 def chain_block_query_POST(chain_uuid: UUID, block_query: BlockQuery):
-    chain = get_chain(str(chain_uuid), cache_ttl=60)
+    chain = get_chain(str(chain_uuid))
+
+    def project(block):
+        serialized = block.serialize()
+        if block_query.fields:
+            return {key: serialized[key] for key in block_query.fields if key in serialized}
 
-    result = chain.block_query(
-        block_query.block_type,
+        return serialized
+
+    query_args = dict(
+        block_type=block_query.block_type,
+        predicates=[predicate.dict() for predicate in block_query.predicates or []],
         attr_query=block_query.attr_query.dict() if block_query.attr_query else None,
         window_far=block_query.window_far,
         window_near=block_query.window_near,
-        multiple=block_query.multiple,
+        offset=block_query.offset or 0,
+        newest_first=bool(block_query.newest_first),
     )
 
-    if block_query.multiple:
-        return [b.serialize() for b in result]
+    try:
+        if block_query.limit is not None or block_query.cursor is not None:
+            result, next_cursor = chain.query_blocks(limit=block_query.limit, cursor=block_query.cursor, **query_args)
+
+            return {
+                'Blocks': [project(b) for b in result],
+                'NextCursor': next_cursor,
+            }
+
+        result = chain.block_query(multiple=block_query.multiple, **query_args)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if block_query.multiple or type(block_query.block_type) is list:
+        return [project(b) for b in result]
     elif result:
-        return result.serialize()
+        return project(result)
 
     return {
         'found': False
@@ -91,35 +205,111 @@ def chains_GET():
     import os
     chain_path = config['DUO_CHAIN_PATH']
 
-    for chain in get_chains(chain_path=chain_path):
-        head_block = chain.head_block()
+    for summary in get_manifest(chain_path).get_entries():
+        try:
+            chain = get_chain(summary['ID'], cache=False)
+        except Exception as e:
+            print(f'Error loading chain {summary["ID"]}: {e}')
+            continue
+
         chains.append({
-            'ID': chain.uuid,
-            'BlockType': BlockTypeMap[head_block.block_type],
-            'HeadHash': head_block.block_hash,
-            'Balance': str(chain.balance()),
-            'BlockHeight': head_block.height,
+            **chain.get_summary(),
             'Blocks': [block.serialize() for block in chain.blocks]
         })
 
     return chains
 
 
+@app.get('/chains/stream')
+def chains_stream_GET(from_height: Optional[int] = None, to_height: Optional[int] = None):
+    # chains_GET as NDJSON, one chain after the other, see stream_chain()
+    chain_path = config['DUO_CHAIN_PATH']
+
+    def stream():
+        for summary in get_manifest(chain_path).get_entries():
+            try:
+                chain = get_chain(summary['ID'], cache=False)
+            except Exception as e:
+                print(f'Error loading chain {summary["ID"]}: {e}')
+                continue
+
+            yield from stream_chain(chain, from_height, to_height)
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+@app.get('/chains/verify')
+def chains_verify_GET(find_invalid: bool = False, incremental: bool = False, workers: Optional[int] = None):
+    # Every chain verified over a process pool, as NDJSON: a line per chain
+    # as it finishes, then a {"Summary": ...} line
+    import json
+    from verify import verify_chains
+
+    chain_path = config['DUO_CHAIN_PATH']
+
+    def stream():
+        t = time.time()
+        num_chains = num_invalid = 0
+
+        for result in verify_chains(chain_path, workers=workers, find_invalid=find_invalid, incremental=incremental):
+            num_chains += 1
+            if not result['Valid']:
+                num_invalid += 1
+
+            yield json.dumps(result) + '\n'
+
+        yield json.dumps({'Summary': {
+            'Chains': num_chains,
+            'Invalid': num_invalid,
+            'Secs': round(time.time() - t, 3),
+        }}) + '\n'
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+@app.get('/chains/cross_verify')
+def chains_cross_verify_GET(verify: bool = True, incremental: bool = False, workers: Optional[int] = None):
+    # Every pair of chains with blocks for each other cross-verified both
+    # ways, each chain loaded once; see verify.cross_verify_chains()
+    from verify import cross_verify_chains
+
+    return cross_verify_chains(config['DUO_CHAIN_PATH'], workers=workers, verify=verify, incremental=incremental)
+
+
 @app.get('/chain/{chain_uuid}')
-def chain_GET(chain_uuid: UUID):
+def chain_GET(chain_uuid: UUID, from_height: Optional[int] = None, to_height: Optional[int] = None):
     chain = get_chain(str(chain_uuid))
-    head_block = chain.head_block()
+    begin, end = chain.get_height_range(from_height, to_height)
 
     return {
-        'ID': chain.uuid,
-        'BlockType': BlockTypeMap[head_block.block_type],
-        'HeadHash': head_block.block_hash,
-        'Balance': str(chain.balance()),
-        'BlockHeight': head_block.height,
-        'Blocks': [block.serialize() for block in chain.blocks]
+        **chain.get_summary(),
+        'Blocks': [block.serialize() for block in chain.blocks[begin:end]]
     }
 
 
+@app.get('/chain/{chain_uuid}/stream')
+def chain_stream_GET(chain_uuid: UUID, from_height: Optional[int] = None, to_height: Optional[int] = None):
+    # chain_GET as NDJSON, written out as it is serialized
+    chain = get_chain(str(chain_uuid))
+
+    return StreamingResponse(stream_chain(chain, from_height, to_height), media_type='application/x-ndjson')
+
+
+def stream_chain(chain, from_height=None, to_height=None, chunk_size=1000):
+    # A {"Chain": <summary>} line, then one line per serialized block between
+    # the heights. Blocks appended meanwhile are left for the next request.
+    import json
+
+    begin, end = chain.get_height_range(from_height, to_height)
+
+    yield json.dumps({'Chain': chain.get_summary()}) + '\n'
+
+    blocks = chain.blocks
+    for chunk_begin in range(begin, end, chunk_size):
+        chunk_end = min(chunk_begin + chunk_size, end)
+        yield ''.join(json.dumps(block.serialize()) + '\n' for block in blocks[chunk_begin:chunk_end])
+
+
 @app.post('/chain')
 def init_chain_POST():
     chain = init_chain()
@@ -130,6 +320,7 @@ def init_chain_POST():
 
 
 @app.put('/chain/{chain_uuid}')
+@chain_writer('chain_uuid')
 def init_chain_from_uuid_PUT(chain_uuid: UUID):
     chain = init_chain(str(chain_uuid))
 
@@ -170,12 +361,15 @@ def read_chain_balance(chain_uuid: UUID):
 
 
 @app.get('/chain/{chain_uuid}/verify')
-def chain_verify_GET(chain_uuid: UUID):
+def chain_verify_GET(chain_uuid: UUID, incremental: bool = False):
+    # incremental=true only re-hashes blocks added since the last successful verify.
+    # No hashing over worker processes here: it forks, and this process has
+    # threads running. verify.py --hash-workers does that instead.
     success = False
     error_message = None
     try:
         chain = get_chain(str(chain_uuid))
-        result = chain.verify()
+        result = chain.verify(incremental=incremental)
     except Exception as e:
         success = False
         error_message = str(e)
@@ -190,28 +384,40 @@ def chain_verify_GET(chain_uuid: UUID):
 
 
 @app.post('/chain/{chain_uuid}/make_valid')
-def chain_block_make_valid_POST(chain_uuid: UUID):
+@chain_writer('chain_uuid')
+def chain_block_make_valid_POST(chain_uuid: UUID, dry_run: bool = False):
+    # dry_run=true returns the repairs that would be made without changing the chain
     success = False
     error_message = None
+    result = None
 
     chain = get_chain(str(chain_uuid))
 
     try:
-        result = chain.make_valid()
+        result = chain.make_valid(dry_run=dry_run)
     except Exception as e:
         success = False
         error_message = str(e)
         import traceback ; traceback.print_exc()
     else:
-        if result and chain.verify(exc=False) is True:
-            chain.save()
+        if dry_run:
+            success = True
+        elif chain.verify(exc=False) is True:
+            if result['Repairs']:
+                chain.save(full=True)
             success = True
         else:
             error_message = 'Chain could not be made valid'
 
+    if not success:
+        # Don't serve a half-repaired chain from the cache
+        chain_cache.discard(chain.uuid)
+
     return {
         'Success': success,
-        'ErrorMessage': error_message
+        'ErrorMessage': error_message,
+        'FirstInvalidIndex': result['FirstInvalidIndex'] if result else None,
+        'Repairs': result['Repairs'] if result else [],
     }
 
 
@@ -220,6 +426,7 @@ class UpdateBlock(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/{block_hash}/update')
+@chain_writer('chain_uuid')
 def chain_block_update_POST(chain_uuid: UUID, block_hash: str, update_block: UpdateBlock):
     success = False
     error_message = None
@@ -229,14 +436,18 @@ def chain_block_update_POST(chain_uuid: UUID, block_hash: str, update_block: Upd
     try:
         update_block_hash = update_block.block['block_hash']
         block_idx = chain.get_block_idx_by_hash(update_block_hash)
-        if block_idx >= 0:
-            block = chain.blocks[block_idx]
-            block.update(**update_block.block)
-            chain.save()
+        if block_idx is None:
+            raise Exception(f'Block not found: {update_block_hash}')
+
+        block = chain.blocks[block_idx]
+        block.update(**update_block.block)
+        chain.invalidate_index()
+        chain.save(full=True)
 
     except Exception as e:
         success = False
         error_message = str(e)
+        chain_cache.discard(chain.uuid)
         import traceback ; traceback.print_exc()
     else:
         success = True
@@ -248,6 +459,7 @@ def chain_block_update_POST(chain_uuid: UUID, block_hash: str, update_block: Upd
 
 
 @app.post('/chain/{chain_uuid}/delete')
+@chain_writer('chain_uuid')
 def chain_delete_POST(chain_uuid: UUID):
     chain = get_chain(str(chain_uuid))
     chain.delete()
@@ -262,6 +474,7 @@ class DeleteBlock(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/{block_hash}/delete')
+@chain_writer('chain_uuid')
 def chain_block_delete_POST(chain_uuid: UUID, block_hash: str, delete_block: DeleteBlock):
     success = False
     error_message = None
@@ -271,14 +484,17 @@ def chain_block_delete_POST(chain_uuid: UUID, block_hash: str, delete_block: Del
     try:
         delete_block_hash = delete_block.block['block_hash']
         block_idx = chain.get_block_idx_by_hash(delete_block_hash)
-        if block_idx >= 0:
-            del chain.blocks[block_idx]
+        if block_idx is None:
+            raise Exception(f'Block not found: {delete_block_hash}')
 
-        chain.save()
+        del chain.blocks[block_idx]
+        chain.invalidate_index()
+        chain.save(full=True)
 
     except Exception as e:
         success = False
         error_message = str(e)
+        chain_cache.discard(chain.uuid)
         import traceback ; traceback.print_exc()
     else:
         success = True
@@ -290,11 +506,11 @@ def chain_block_delete_POST(chain_uuid: UUID, block_hash: str, delete_block: Del
 
 
 @app.get('/chain/{chain_uuid}/cross_verify/{other_chain_uuid}')
-def chain_cross_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID):
+def chain_cross_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID, incremental: bool = False):
     success = False
     error_message = None
     try:
-        cross_verify(chain_uuid, other_chain_uuid)
+        cross_verify(chain_uuid, other_chain_uuid, incremental=incremental)
     except Exception as e:
         success = False
         error_message = str(e)
@@ -308,20 +524,25 @@ def chain_cross_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID):
 
 
 @app.get('/chain/{chain_uuid}/hard_verify/{other_chain_uuid}')
-def chain_hard_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID):
+@chain_writer('chain_uuid', 'other_chain_uuid')
+def chain_hard_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID, incremental: bool = False, merkle: Optional[bool] = None):
+    # merkle=true also commits Merkle roots of the verified sub-chains,
+    # see /chain/{chain_uuid}/verification/{verification_block_hash}/proof
     success = False
     error_message = None
     try:
-        cross_verify(chain_uuid, other_chain_uuid)
+        cross_verify(chain_uuid, other_chain_uuid, incremental=incremental)
 
         chain = get_chain(str(chain_uuid))
         other_chain = get_chain(str(other_chain_uuid))
 
-        chain.hard_verify(other_chain)
-        other_chain.hard_verify(chain)
+        chain.hard_verify(other_chain, merkle=merkle)
+        other_chain.hard_verify(chain, merkle=merkle)
     except Exception as e:
         success = False
         error_message = str(e)
+        chain_cache.discard(str(chain_uuid))
+        chain_cache.discard(str(other_chain_uuid))
     else:
         success = True
 
@@ -331,14 +552,41 @@ def chain_hard_verify_GET(chain_uuid: UUID, other_chain_uuid: UUID):
     }
 
 
-def cross_verify(chain_uuid, other_chain_uuid):
+@app.get('/chain/{chain_uuid}/verification/{verification_block_hash}/proof/{block_hash}')
+def chain_verification_proof_GET(chain_uuid: UUID, verification_block_hash: str, block_hash: str):
+    # Merkle inclusion proof that block_hash is covered by a Verification
+    # block, checked with merkle.verify_proof(BlockHash, Proof, Root). Given
+    # a VerificationClose block, the proof comes from the verifying chain.
+    chain = get_chain(str(chain_uuid))
+
+    block = chain.get_block_by_hash(verification_block_hash)
+    if block and block.block_type == BlockType.VerificationClose:
+        try:
+            other_chain = get_chain(block.dest_chain_id)
+        except Exception:
+            # The verifying chain isn't stored here
+            proof = None
+        else:
+            proof = chain.get_verification_close_proof(verification_block_hash, block_hash, other_chain)
+    else:
+        proof = chain.get_verification_proof(verification_block_hash, block_hash)
+
+    if not proof:
+        return {
+            'found': False
+        }
+
+    return proof
+
+
+def cross_verify(chain_uuid, other_chain_uuid, incremental=False):
     chain = get_chain(str(chain_uuid))
     other_chain = get_chain(str(other_chain_uuid))
 
     # First make sure that both chains are individually valid.
     # Doing this first simplifies the cross-verification.
-    chain.verify()
-    other_chain.verify()
+    chain.verify(incremental=incremental)
+    other_chain.verify(incremental=incremental)
 
     # Then make sure that each chain corroborates the other.
     chain.cross_verify(other_chain)
@@ -367,33 +615,49 @@ def query_received_signals_POST(chain_uuid: UUID, query_received_signals: QueryR
 
     signals = []
     try:
-        for block in chain.blocks:
-            # Do blocks even have timestamps?
-            #   uhhh...
+        # Already in timestamp order
+        for block in chain.activity_query(activity_uuid, BlockType.SignalDelivered, epoch_from_ms, epoch_to_ms):
+            signals.append({
+                'block_hash': block.block_hash,
+                'ts': int(block.ts),
+                'cost': block.cost,
+                'source_chain_uuid': block.src_chain_id
+            })
+    except Exception as e:
+        success = False
+        error_message = str(e)
+        import traceback ; traceback.print_exc()
+    else:
+        success = True
 
-            if block.block_type not in (BlockType.SignalDelivered, ):
-                continue
+    return {
+        'Success': success,
+        'ErrorMessage': error_message,
+        'signals': signals
+    }
 
-            ts = int(block.ts)
 
-            if ts < epoch_from_ms:
-                continue
+class ActivityQuery(BaseModel):
+    block_type: Optional[Union[int, list]] = None
+    epoch_from: Optional[int] = None
+    epoch_to: Optional[int] = None
 
-            if ts > epoch_to_ms:
-                continue
 
-            if block.activity_id != activity_uuid:
-                continue
+@app.post('/chain/{chain_uuid}/activity/{activity_uuid}/query')
+def activity_query_POST(chain_uuid: UUID, activity_uuid: UUID, activity_query: ActivityQuery):
+    # SignalDelivered, Action and WorkOutput blocks of one activity, in timestamp order
+    success = False
+    error_message = None
 
-            signals.append({
-                'block_hash': block.block_hash,
-                'ts': ts,
-                'cost': block.cost,
-                'source_chain_uuid': block.src_chain_id
-            })
+    epoch_from_ms = activity_query.epoch_from * 1000 if activity_query.epoch_from is not None else None
+    epoch_to_ms = activity_query.epoch_to * 1000 if activity_query.epoch_to is not None else None
 
-        signals.sort(key=lambda x: x['ts'], reverse=False)
+    chain = get_chain(str(chain_uuid))
 
+    blocks = []
+    try:
+        for block in chain.activity_query(str(activity_uuid), activity_query.block_type, epoch_from_ms, epoch_to_ms):
+            blocks.append(block.serialize())
     except Exception as e:
         success = False
         error_message = str(e)
@@ -404,7 +668,7 @@ def query_received_signals_POST(chain_uuid: UUID, query_received_signals: QueryR
     return {
         'Success': success,
         'ErrorMessage': error_message,
-        'signals': signals
+        'blocks': blocks
     }
 
 
@@ -416,6 +680,7 @@ class SendSignal(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/send_signal')
+@chain_writer('chain_uuid')
 def create_block__send_signal(chain_uuid: UUID, send_signal: SendSignal):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(send_signal.other_chain_uuid)
@@ -427,46 +692,49 @@ def create_block__send_signal(chain_uuid: UUID, send_signal: SendSignal):
         reward_amount = None
 
     chain = get_chain(chain_uuid)
-    send_signal_block = chain.send_signal(
-        other_chain_uuid,
-        signal_data,
-        amount=reward_amount
-    )
-    prev_block_hash = send_signal_block.prev_block_hash
-
-    emit_state_change(service_name, 'BlockAdded', {
-        'BlockType': 'SendSignal',
-        'OnChainID': chain_uuid,
-        'OtherChainID': other_chain_uuid,
-        'BlockHash': send_signal_block.block_hash,
-        'PrevBlockHash': prev_block_hash,
-        'Signal': send_signal.signal_data,
-        'SerializedBlock': send_signal_block.serialize(),
-        'RewardAmount': reward_amount,
-        #'SerializedDebitBlock': debit_block.serialize() if debit_block else None,
-    })
 
-    debit_block = None
-    if send_signal.debit and reward_amount:
-        ref_block_hash = send_signal_block.block_hash
-        debit_block = chain.debit(
-            reward_amount,
-            ref_block_hash=ref_block_hash
+    # The signal and its debit are saved together
+    with chain.batch():
+        send_signal_block = chain.send_signal(
+            other_chain_uuid,
+            signal_data,
+            amount=reward_amount
         )
-        prev_block_hash = debit_block.prev_block_hash
+        prev_block_hash = send_signal_block.prev_block_hash
 
         emit_state_change(service_name, 'BlockAdded', {
-            'BlockType': 'Debit',
+            'BlockType': 'SendSignal',
             'OnChainID': chain_uuid,
-            'Amount': str(reward_amount),
-            'RefBlockHash': ref_block_hash,
-            'BlockHash': debit_block.block_hash,
+            'OtherChainID': other_chain_uuid,
+            'BlockHash': send_signal_block.block_hash,
             'PrevBlockHash': prev_block_hash,
-            'Balance': str(debit_block.balance),
-            'BalanceDelta': str(debit_block.balance_delta),
-            'SerializedBlock': debit_block.serialize()
+            'Signal': send_signal.signal_data,
+            'SerializedBlock': send_signal_block.serialize(),
+            'RewardAmount': reward_amount,
+            #'SerializedDebitBlock': debit_block.serialize() if debit_block else None,
         })
 
+        debit_block = None
+        if send_signal.debit and reward_amount:
+            ref_block_hash = send_signal_block.block_hash
+            debit_block = chain.debit(
+                reward_amount,
+                ref_block_hash=ref_block_hash
+            )
+            prev_block_hash = debit_block.prev_block_hash
+
+            emit_state_change(service_name, 'BlockAdded', {
+                'BlockType': 'Debit',
+                'OnChainID': chain_uuid,
+                'Amount': str(reward_amount),
+                'RefBlockHash': ref_block_hash,
+                'BlockHash': debit_block.block_hash,
+                'PrevBlockHash': prev_block_hash,
+                'Balance': str(debit_block.balance),
+                'BalanceDelta': str(debit_block.balance_delta),
+                'SerializedBlock': debit_block.serialize()
+            })
+
     return {
         'send_signal_block_hash': send_signal_block.block_hash,
     }
@@ -481,6 +749,7 @@ class ReceiveSignal(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/receive_signal')
+@chain_writer('chain_uuid')
 def create_block__receive_signal(chain_uuid: UUID, receive_signal: ReceiveSignal):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(receive_signal.other_chain_uuid)
@@ -524,6 +793,7 @@ class DeliverSignal(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/deliver_signal')
+@chain_writer('chain_uuid')
 def create_block__deliver_signal(chain_uuid: UUID, deliver_signal: DeliverSignal):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(deliver_signal.other_chain_uuid)
@@ -568,6 +838,7 @@ class SendSignalReward(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/send_signal_reward')
+@chain_writer('chain_uuid')
 def create_block__send_signal_reward(chain_uuid: UUID, send_signal_reward: SendSignalReward):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(send_signal_reward.other_chain_uuid)
@@ -609,6 +880,7 @@ class ReceiveSignalReward(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/receive_signal_reward')
+@chain_writer('chain_uuid')
 def create_block__receive_signal_reward(chain_uuid: UUID, receive_signal_reward: ReceiveSignalReward):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(receive_signal_reward.other_chain_uuid)
@@ -652,6 +924,7 @@ class AddTarget(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/target')
+@chain_writer('chain_uuid')
 def create_block__target(chain_uuid: UUID, new_target: AddTarget):
     chain_uuid = str(chain_uuid)
 
@@ -709,6 +982,7 @@ class AcceptTarget(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/accept_target')
+@chain_writer('chain_uuid')
 def create_block__accept_target(chain_uuid: UUID, accepted_target: AcceptTarget):
     chain_uuid = str(chain_uuid)
 
@@ -757,6 +1031,7 @@ class AddAction(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/action')
+@chain_writer('chain_uuid')
 def create_block__action(chain_uuid: UUID, new_action: AddAction):
     chain_uuid = str(chain_uuid)
     action_uuid = str(new_action.action_uuid)
@@ -806,6 +1081,7 @@ class AddWorkOutput(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/work_output')
+@chain_writer('chain_uuid')
 def create_block__work_output(chain_uuid: UUID, new_work_output: AddWorkOutput):
     chain_uuid = str(chain_uuid)
     action_uuid = str(new_work_output.action_uuid)
@@ -859,6 +1135,7 @@ class AddSendTargetRewardClaim(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/send_target_reward_claim')
+@chain_writer('chain_uuid')
 def create_block__send_target_reward_claim(chain_uuid: UUID, new_reward_claim: AddSendTargetRewardClaim):
     chain_uuid = str(chain_uuid)
     target_src_chain_uuid = str(new_reward_claim.target_src_chain_uuid)
@@ -906,6 +1183,7 @@ class AddReceiveTargetRewardClaim(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/receive_target_reward_claim')
+@chain_writer('chain_uuid')
 def create_block__receive_target_reward_claim(chain_uuid: UUID, new_reward_claim: AddReceiveTargetRewardClaim):
     chain_uuid = str(chain_uuid)
     claim_src_chain_uuid = str(new_reward_claim.claim_src_chain_uuid)
@@ -955,6 +1233,7 @@ class AddSendTargetReward(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/send_target_reward')
+@chain_writer('chain_uuid')
 def create_block__send_target_reward(chain_uuid: UUID, new_reward: AddSendTargetReward):
     chain_uuid = str(chain_uuid)
     claim_src_chain_uuid = str(new_reward.claim_src_chain_uuid)
@@ -999,6 +1278,7 @@ class AddReceiveTargetReward(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/receive_target_reward')
+@chain_writer('chain_uuid')
 def create_block__receive_target_reward(chain_uuid: UUID, new_reward: AddReceiveTargetReward):
     chain_uuid = str(chain_uuid)
     target_src_chain_uuid = str(new_reward.target_src_chain_uuid)
@@ -1040,6 +1320,7 @@ class AddDebit(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/debit')
+@chain_writer('chain_uuid')
 def create_block__debit(chain_uuid: UUID, new_debit: AddDebit):
     chain_uuid = str(chain_uuid)
 
@@ -1077,6 +1358,7 @@ class AcceptCredit(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/accept_credit')
+@chain_writer('chain_uuid')
 def create_block__debit(chain_uuid: UUID, new_credit: AcceptCredit):
     chain_uuid = str(chain_uuid)
 
@@ -1120,6 +1402,7 @@ class AccessContractOwn(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/access_contract_own')
+@chain_writer('chain_uuid')
 def create_block__access_contract_own(chain_uuid: UUID, access_contract: AccessContractOwn):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(access_contract.other_chain_uuid)
@@ -1167,6 +1450,7 @@ class AccessContractOther(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/access_contract_other')
+@chain_writer('chain_uuid')
 def create_block__access_contract_other(chain_uuid: UUID, access_contract: AccessContractOther):
     chain_uuid = str(chain_uuid)
     other_chain_uuid = str(access_contract.other_chain_uuid)
@@ -1211,6 +1495,7 @@ class AccessContractOtherEventOpen(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/access_contract_other_event_open')
+@chain_writer('chain_uuid')
 def create_block__access_contract_other_event_open(chain_uuid: UUID, contract_event: AccessContractOtherEventOpen):
     chain_uuid = str(chain_uuid)
     chain = get_chain(chain_uuid)
@@ -1262,6 +1547,7 @@ class AccessContractOwnEventAsk(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/access_contract_own_event_ask')
+@chain_writer('chain_uuid')
 def create_block__access_contract_own_event_ask(chain_uuid: UUID, contract_event: AccessContractOwnEventAsk):
     chain_uuid = str(chain_uuid)
     chain = get_chain(chain_uuid)
@@ -1307,6 +1593,7 @@ class AccessContractOtherEventClose(BaseModel):
 
 
 @app.post('/chain/{chain_uuid}/block/access_contract_other_event_close')
+@chain_writer('chain_uuid')
 def create_block__access_contract_other_event_close(chain_uuid: UUID, contract_event: AccessContractOtherEventClose):
     chain_uuid = str(chain_uuid)
     chain = get_chain(chain_uuid)
@@ -1368,17 +1655,8 @@ def get_current_state():
         'Chains': []
     }
 
-    import os
+    # Served from the manifest, no chain is loaded. Run `manifest.py rebuild` if it looks stale.
     chain_path = config['DUO_CHAIN_PATH']
-
-    for chain in get_chains(chain_path=chain_path):
-        head_block = chain.head_block()
-        state['Chains'].append({
-            'ID': chain.uuid,
-            'BlockType': BlockTypeMap[head_block.block_type],
-            'HeadHash': head_block.block_hash,
-            'Balance': str(chain.balance()),
-            'BlockHeight': head_block.height
-        })
+    state['Chains'] = get_manifest(chain_path).get_entries()
 
     return state
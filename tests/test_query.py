@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_empty_value_predicate_isnt_taken_from_an_index(tmp_path):
+    # The ref/peer/activity indexes don't hold empty values, so an eq
+    # predicate on '' has to scan rather than take an empty candidate set
+    from config import config
+    config['DUO_CHAIN_PATH'] = str(tmp_path)
+
+    from blocks import BlockType
+    from chain import init_chain
+
+    chain = init_chain()
+    chain.add_action('action-1', 'activity-1', {'prior': ['x']})
+
+    predicates = [{'key': 'deliver_signal_block_hash', 'value': ''}]
+    blocks = chain.block_query(BlockType.Action, predicates=predicates, multiple=True)
+    scanned = chain.block_query(BlockType.Action, attr_query={'key': 'deliver_signal_block_hash', 'value': '', 'value_type': 'str'}, multiple=True)
+
+    assert len(blocks) == len(scanned) == 1
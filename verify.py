@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+
+import os
+import time
+import threading
+
+
+# Fewer blocks than this to hash aren't worth starting worker processes for
+PARALLEL_MIN_BLOCKS = 20000
+
+# What the forked workers of hash_blocks() read from, inherited rather than sent
+hash_lock = threading.Lock()
+hash_job = None
+
+
+def hash_blocks(blocks, begin_idx=0, workers=None):
+    # Hashes the blocks from begin_idx on that have no Block.computed_hash
+    # yet over forked worker processes, and fills in their computed_hash,
+    # so the linear verify()/find_invalid() pass after it only has to
+    # compare hashes. Returns how many blocks were hashed here.
+    #
+    # The blocks mustn't change until this returns (see Chain.prehash()).
+    # Without fork (or with a single worker) nothing is done and the linear
+    # pass hashes them as usual. Forking only suits a single threaded
+    # process like this module's CLI, not the server.
+    global hash_job
+    from multiprocessing import get_context, get_all_start_methods
+
+    workers = workers or os.cpu_count() or 1
+    if workers < 2 or 'fork' not in get_all_start_methods():
+        return 0
+
+    positions = [idx for idx in range(begin_idx, len(blocks)) if blocks[idx].computed_hash is None]
+    if len(positions) < PARALLEL_MIN_BLOCKS:
+        return 0
+
+    segment_size = max(1000, len(positions) // (workers * 4) + 1)
+    segments = [(begin, min(begin + segment_size, len(positions))) for begin in range(0, len(positions), segment_size)]
+
+    with hash_lock:
+        hash_job = (blocks, positions)
+        try:
+            with get_context('fork').Pool(min(workers, len(segments))) as pool:
+                for (begin, end), digests in zip(segments, pool.imap(hash_segment, segments)):
+                    for idx, digest in zip(positions[begin:end], digests):
+                        if digest is not None:
+                            blocks[idx].computed_hash = digest
+        finally:
+            hash_job = None
+
+    return len(positions)
+
+
+def hash_segment(segment):
+    # In a worker: digests of positions[begin:end], None where hashing fails
+    # (the linear pass then fails on the block the same way)
+    blocks, positions = hash_job
+    begin, end = segment
+
+    digests = []
+    for idx in positions[begin:end]:
+        try:
+            digests.append(blocks[idx].generate_hash(assign=False))
+        except Exception:
+            digests.append(None)
+
+    return digests
+
+
+def verify_chain_file(chain_file, find_invalid=False, incremental=False, hash_workers=None):
+    # Chain.verify() (and find_invalid()) of one chain file, as a plain
+    # dict so it can come back from a worker process
+    from chain import Chain, get_loader
+
+    t = time.time()
+    result = {
+        'ID': chain_file_uuid(chain_file),
+        'Valid': False,
+        'Blocks': None,
+        'ErrorMessage': None,
+        'InvalidIndex': None,
+        'InvalidHash': None,
+    }
+
+    try:
+        chain = Chain(None, get_loader(chain_file))
+        result['ID'] = chain.uuid
+        result['Blocks'] = len(chain.blocks)
+
+        verified = chain.verify(exc=False, incremental=incremental, workers=hash_workers)
+        result['Valid'] = verified is True
+
+        if verified is not True:
+            # verify() walks from the head, so this is the newest bad block
+            block, idx = verified
+            result['InvalidIndex'] = idx
+            result['InvalidHash'] = block.block_hash
+
+        if find_invalid:
+            invalid = chain.find_invalid(workers=hash_workers)
+            if invalid is not True:
+                block, idx = invalid
+                result['FirstInvalidIndex'] = idx
+                result['FirstInvalidHash'] = block.block_hash
+            else:
+                result['FirstInvalidIndex'] = None
+                result['FirstInvalidHash'] = None
+
+    except Exception as e:
+        result['ErrorMessage'] = str(e)
+
+    result['Secs'] = round(time.time() - t, 3)
+
+    return result
+
+
+def chain_file_uuid(chain_file):
+    # chain_<uuid>.json[l] -> <uuid>
+    name = os.path.splitext(os.path.basename(chain_file))[0]
+    return name[len('chain_'):] if name.startswith('chain_') else name
+
+
+def find_chain_files(chain_path, chain_ids=None):
+    # Largest first, so one big chain doesn't start last and hold up the end
+    from chain import get_chain_file, get_chain_files
+
+    if chain_ids:
+        chain_files = []
+        for chain_id in chain_ids:
+            chain_file = get_chain_file(chain_path, chain_id)
+            if not chain_file:
+                print(f'Chain not found: {chain_id}')
+                continue
+            chain_files.append(chain_file)
+    else:
+        chain_files = get_chain_files(chain_path)
+
+    chain_files.sort(key=lambda chain_file: os.path.getsize(chain_file), reverse=True)
+
+    return chain_files
+
+
+def map_chain_files(fn, chain_files, workers=None, *args):
+    # fn(chain_file, *args) for every chain file over a pool of worker
+    # processes, yielding the results as they finish
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing import get_context
+
+    if not chain_files:
+        return
+
+    # Spawned rather than forked: the server process has threads running
+    workers = min(workers or os.cpu_count() or 1, len(chain_files))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        futures = [executor.submit(fn, chain_file, *args) for chain_file in chain_files]
+
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def verify_chains(chain_path, chain_ids=None, workers=None, find_invalid=False, incremental=False, hash_workers=None):
+    # Verifies every chain in chain_path (or just chain_ids) over a pool of
+    # worker processes, one chain per task. Yields each chain's result as
+    # soon as it is done, with Done/Total to follow progress by.
+    #
+    # With hash_workers the chains are instead verified one at a time in
+    # this process, each one's blocks hashed over hash_workers processes:
+    # for a few very long chains rather than many.
+    chain_files = find_chain_files(chain_path, chain_ids)
+    total = len(chain_files)
+
+    if hash_workers:
+        results = (verify_chain_file(chain_file, find_invalid, incremental, hash_workers) for chain_file in chain_files)
+    else:
+        results = map_chain_files(verify_chain_file, chain_files, workers, find_invalid, incremental)
+
+    for done, result in enumerate(results, 1):
+        yield {**result, 'Done': done, 'Total': total}
+
+
+# Block types Chain.cross_verify() matches up between two chains, with the
+# field naming the other chain and, on the receiving side, the field
+# referencing the sending block
+LINK_FIELDS = {
+    'SignalSent': ('dest_chain_id', None),
+    'SignalRewardSent': ('dest_chain_id', None),
+    'SignalReceived': ('src_chain_id', 'send_signal_block_hash'),
+    'SignalRewardReceived': ('src_chain_id', 'send_signal_reward_block_hash'),
+}
+
+
+def get_chain_links(chain):
+    # What Chain.get_linked_blocks() finds for every other chain at once:
+    # other chain id -> {
+    #     'SignalSent' / 'SignalRewardSent': set of their block hashes,
+    #     'SignalReceived' / 'SignalRewardReceived': {block hash: hash of the sending block},
+    # }
+    from blocks import BlockTypeMap
+
+    links = {}
+    for block in chain.blocks:
+        fields = LINK_FIELDS.get(BlockTypeMap.get(block.block_type))
+        if not fields:
+            continue
+
+        chain_id_field, ref_field = fields
+        other_chain_id = getattr(block, chain_id_field)
+
+        chain_links = links.get(other_chain_id)
+        if chain_links is None:
+            chain_links = links[other_chain_id] = {
+                'SignalSent': set(),
+                'SignalRewardSent': set(),
+                'SignalReceived': {},
+                'SignalRewardReceived': {},
+            }
+
+        block_type = BlockTypeMap[block.block_type]
+        if ref_field:
+            chain_links[block_type][block.block_hash] = getattr(block, ref_field)
+        else:
+            chain_links[block_type].add(block.block_hash)
+
+    return links
+
+
+def link_chain_file(chain_file, verify=True, incremental=False):
+    # get_chain_links() of one chain file, and its verify() if asked
+    from chain import Chain, get_loader
+
+    result = {
+        'ID': chain_file_uuid(chain_file),
+        'Valid': None,
+        'ErrorMessage': None,
+        'Links': None,
+    }
+
+    try:
+        chain = Chain(None, get_loader(chain_file))
+        result['ID'] = chain.uuid
+
+        if verify:
+            result['Valid'] = chain.verify(exc=False, incremental=incremental) is True
+
+        result['Links'] = get_chain_links(chain)
+    except Exception as e:
+        result['ErrorMessage'] = str(e)
+
+    return result
+
+
+def check_links(links, other_links):
+    # Chain.cross_verify() from the chain with links to the one with
+    # other_links: how many of its received signals and rewards have no
+    # sending block there
+    unmatched = {}
+    for received_type, sent_type in (('SignalReceived', 'SignalSent'), ('SignalRewardReceived', 'SignalRewardSent')):
+        sent_hashes = other_links[sent_type] if other_links else set()
+        sent_block_hashes = list(links[received_type].values())
+
+        unmatched[received_type] = len(sent_block_hashes) - len(set(sent_block_hashes) & sent_hashes)
+
+    return unmatched
+
+
+def cross_verify_chains(chain_path, chain_ids=None, workers=None, verify=True, incremental=False):
+    # Chain.cross_verify() both ways over every pair of chains that have
+    # blocks for each other, loading each chain once (over worker
+    # processes) and comparing the hashes they link by. With verify each
+    # chain is also verified, as server.cross_verify() does per pair.
+    import time
+
+    t = time.time()
+    chain_files = find_chain_files(chain_path, chain_ids)
+
+    chain_links = {}
+    invalid = []
+    for result in map_chain_files(link_chain_file, chain_files, workers, verify, incremental):
+        if result['ErrorMessage'] or result['Valid'] is False:
+            invalid.append({'ID': result['ID'], 'Valid': result['Valid'], 'ErrorMessage': result['ErrorMessage']})
+
+        if result['Links'] is not None:
+            chain_links[result['ID']] = result['Links']
+
+    pairs = set()
+    mismatched = []
+    for chain_id, links in chain_links.items():
+        for other_chain_id, peer_links in links.items():
+            pairs.add(tuple(sorted((chain_id, other_chain_id))))
+
+            other_links = chain_links.get(other_chain_id)
+            unmatched = check_links(peer_links, other_links.get(chain_id) if other_links else None)
+
+            if other_links is None or any(unmatched.values()):
+                mismatched.append({
+                    'ID': chain_id,
+                    'OtherID': other_chain_id,
+                    'OtherChainFound': other_links is not None,
+                    'UnmatchedSignals': unmatched['SignalReceived'],
+                    'UnmatchedRewards': unmatched['SignalRewardReceived'],
+                })
+
+    return {
+        'Chains': len(chain_links),
+        'Pairs': len(pairs),
+        'Mismatched': mismatched,
+        'Invalid': invalid,
+        'Secs': round(time.time() - t, 3),
+    }
+
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+    from config import config
+
+    parser = argparse.ArgumentParser(description='Verify chains in parallel, one line of JSON per chain as it finishes')
+    parser.add_argument('chain_ids', nargs='*', help='chains to verify (default: all)')
+    parser.add_argument('--path', default=config.get('DUO_CHAIN_PATH'), help='chain directory (default: DUO_CHAIN_PATH)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--find-invalid', action='store_true', help='also report the earliest invalid block')
+    parser.add_argument('--incremental', action='store_true', help='only check blocks added since the last successful verify')
+    parser.add_argument('--hash-workers', type=int, help='verify chains one at a time, hashing each over this many processes')
+    parser.add_argument('--cross', action='store_true', help='cross-verify every pair of linked chains instead, printing one JSON report')
+    args = parser.parse_args()
+
+    if args.cross:
+        report = cross_verify_chains(args.path, args.chain_ids, args.workers, incremental=args.incremental)
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if report['Mismatched'] or report['Invalid'] else 0)
+
+    t = time.time()
+    num_invalid = 0
+    num_chains = 0
+
+    for result in verify_chains(args.path, args.chain_ids, args.workers, args.find_invalid, args.incremental, args.hash_workers):
+        num_chains += 1
+        if not result['Valid']:
+            num_invalid += 1
+
+        print(json.dumps(result), flush=True)
+
+    print(f'Verified {num_chains} chains in {time.time() - t:.1f}s, {num_invalid} invalid', file=sys.stderr)
+
+    sys.exit(1 if num_invalid else 0)